@@ -1,14 +1,16 @@
 
+import argparse
 import json
 import sys
 from pathlib import Path
 import toml
 import yaml
 from pydcam.utils.tomlencoder import MyTomlEncoder
-from PyQt5 import QtWidgets as QtW
 
 def open_config(file_path=""):
     if not Path(file_path).is_absolute():
+        # only needed for the file dialog, so headless use doesn't need Qt
+        from PyQt5 import QtWidgets as QtW
         app = QtW.QApplication.instance()
         if app is None:
             app = QtW.QApplication([])
@@ -35,8 +37,25 @@ def open_config(file_path=""):
         print("Wrong file type")
         return None
 
+def reader_args(argv=None):
+    """The config file and buffer history options for the camera programs, anything
+    else (e.g. Qt's own options) is left alone"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", nargs="?", help="camera config file (toml, yaml or json)")
+    parser.add_argument("--history", type=int, default=None,
+        help="frames kept in the camera buffer for Save Buffer, default 10, or 1000 with --history-path")
+    parser.add_argument("--history-path", default=None,
+        help="keep the buffer in a memory mapped file here so the history can be deep")
+    args = parser.parse_known_args(sys.argv[1:] if argv is None else argv)[0]
+    if args.history is None:
+        args.history = 10 if args.history_path is None else 1000
+    if args.config is not None:
+        args.config = Path(args.config).resolve()
+    return args
+
 def save_config(indict, file_path=""):
     if not Path(file_path).is_absolute():
+        from PyQt5 import QtWidgets as QtW
         if QtW.QApplication.instance() is None:
             app = QtW.QApplication([])
         file_path = QtW.QFileDialog.getSaveFileName(None,"Save Config File",str(Path.home()/file_path),"Config Files (*.toml *.yaml *.json)")[0]
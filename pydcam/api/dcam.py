@@ -532,11 +532,20 @@ class Dcam:
 
     # dcambuf functions
 
-    def buf_attach(self, number_of_buffer):
+    def buf_attach(self, frames):
         """
         Use the buffer attaching method to acquire frames.
+        The camera writes frame k directly into frames[k%N], no copy is needed.
         Cannot be used with buf_alloc.
-        NOT TESTED, DO NOT USE
+
+        Arg:
+            arg1(numpy.ndarray): C-contiguous array of shape (N, height, width),
+                each frame must be BUFFER_FRAMEBYTES long.
+                A reference is kept until buf_release()
+
+        Returns:
+            True:   buffers are attached
+            False:  error happens.  lasterr() returns the DCAMERR value
         """
 
         if not self.is_opened():
@@ -546,26 +555,33 @@ class Dcam:
             print("Already using the alloc method")
             return False
 
-        self.__attach_pFrames = (c_void_p * number_of_buffer)()
         bufframebytes = self.prop_getvalue(DCAM_IDPROP.BUFFER_FRAMEBYTES)
         if not bufframebytes:
             print("Error in getvalue(DCAM_IDPROP.BUFFER_FRAMEBYTES)")
             return False
-        self.__attach_buffer = (c_char * number_of_buffer * bufframebytes)(0)
-        for i in range(number_of_buffer):
-            self.__attach_pFrames[i] = pointer(self.__attach_buffer)+i*bufframebytes
+
+        if not frames.flags['C_CONTIGUOUS'] or frames[0].nbytes != int(bufframebytes):
+            print(f"Wrong size frames to attach: {frames[0].nbytes} != {int(bufframebytes)}")
+            return False
+
+        number_of_buffer = len(frames)
+        self.__attach_buffer = frames
+        self.__attach_pFrames = (c_void_p * number_of_buffer)(*[frames[i].ctypes.data for i in range(number_of_buffer)])
+
         bufattach = DCAMBUF_ATTACH()
         bufattach.iKind = DCAMBUF_ATTACHKIND.FRAME
-        bufattach.buffer = self.__attach_pFrames
+        bufattach.buffer = cast(self.__attach_pFrames, c_void_p)
         bufattach.buffercount = number_of_buffer
 
         ret = self.__result(dcambuf_attach(self.__hdcam, byref(bufattach)))
         if ret is False:
+            self.__attach_buffer = None
+            self.__attach_pFrames = None
             return False
 
         self.__buf_attached = True
 
-        return (self.__attach_pFrames, number_of_buffer)
+        return self.__result(dcammisc_setupframe(self.__hdcam, self.__bufframe))
 
     def buf_alloc(self, nFrame):
         """
@@ -613,6 +629,8 @@ class Dcam:
 
         self.__attach_buffer = None
         self.__attach_pFrames = None
+        self.__buf_attached = False
+        self.__buf_alloced = False
 
         return retval
 
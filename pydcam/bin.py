@@ -2,12 +2,11 @@
 
 import sys
 from PyQt5 import QtWidgets as QtW
-from pathlib import Path
 from pydcam.dcam_reader import DCamReader
 from pydcam.dcam_gui import ControlWindow, ConsoleLog
 from pydcam.api import OpenCamera
 from pydcam.api.dcamapi4 import DCAM_IDPROP
-from pydcam import open_config
+from pydcam import open_config, reader_args
 from pydcam.dcam_display import ImageUpdater
 from pydcam.dcam_saver import CamSaver
 from pydcam.utils.zmq_pubsub import zmq_reader, zmq_publisher
@@ -18,9 +17,8 @@ MAX_SIZE = 2304*2304*2
 def gui():
     iDevice = 0
 
-    fname = None
-    if len(sys.argv) > 1:
-        fname = Path(sys.argv[1]).resolve()
+    args = reader_args()
+    fname = args.config
 
     app = QtW.QApplication(sys.argv)
 
@@ -45,7 +43,7 @@ def gui():
             init_dict = open_config(fname)
             if init_dict: dcam.prop_setfromdict(init_dict)
 
-        reader = DCamReader(dcam)
+        reader = DCamReader(dcam, history=args.history, history_path=args.history_path)
         try:
             # this_zmq = zmq_publisher()
             this_zmq = shmem_publisher(size=MAX_SIZE)
@@ -71,9 +69,8 @@ def gui():
 def reader():
     iDevice = 0
 
-    fname = None
-    if len(sys.argv) > 1:
-        fname = Path(sys.argv[1]).resolve()
+    args = reader_args()
+    fname = args.config
 
     with OpenCamera(iDevice) as dcam:
 
@@ -84,7 +81,7 @@ def reader():
             init_dict = open_config(fname)
             if init_dict: dcam.prop_setfromdict(init_dict)
 
-        camreader = DCamReader(dcam)
+        camreader = DCamReader(dcam, history=args.history, history_path=args.history_path)
         try:
             # this_zmq = zmq_publisher()
             this_zmq = shmem_publisher(size=MAX_SIZE)
@@ -120,10 +117,10 @@ def reader():
 def saver():
 
     # read_zmq = zmq_reader()
-    read_zmq = shmem_reader()
+    read_zmq = shmem_reader(policy="drop")
 
     app = QtW.QApplication(sys.argv)
-    this = CamSaver(read_zmq.oneshot,read_zmq.multishot)
+    this = CamSaver(read_zmq.oneshot,read_zmq.multishot_into,register_func=read_zmq.register)
     this.show()
 
     with read_zmq:
@@ -132,13 +129,13 @@ def saver():
 def display():
 
     # this_zmq = zmq_reader(ratelimit=0.01)
-    this_zmq = shmem_reader(ratelimit=0.01)
+    this_zmq = shmem_reader()
 
     app = QtW.QApplication(sys.argv)
     this = ImageUpdater()
     this.show()
 
-    this_zmq.register(this.update_trigger)
+    this_zmq.register(this.update_trigger, max_rate=100)
 
     with this_zmq:
         sys.exit(app.exec())
@@ -445,7 +445,7 @@ class ImageDisplay(ImageDisplay_base):
 
     def update_trigger(self, data):
         if not self.wait_event.is_set():
-            self.data = data
+            self.data = data if data.flags.writeable else data.copy()
             self.wait_event.set()
 
     def update_once(self, data):
@@ -589,7 +589,8 @@ class ImageUpdater(QtW.QWidget):
             self.fps_cb = func
 
     def update_trigger(self, data:numpy.ndarray):
-        self.indata = data
+        # read-only data may be a leased view that gets reused after this returns
+        self.indata = data if data.flags.writeable else data.copy()
 
     def update(self):
         if self.indata is not None:
@@ -796,14 +797,14 @@ if __name__ == "__main__":
     from pydcam.utils.shmem import shmem_reader
 
     # this_zmq = zmq_reader(ratelimit=0.05)
-    this_zmq = shmem_reader(ratelimit=0.05)
+    this_zmq = shmem_reader()
 
     app = QtW.QApplication(sys.argv)
     
     this = ImageUpdater()
     this.show()
 
-    this_zmq.register(this.update_trigger)
+    this_zmq.register(this.update_trigger, max_rate=20)
 
     with this_zmq:
         sys.exit(app.exec())
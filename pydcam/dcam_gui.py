@@ -12,7 +12,7 @@ from pyqtgraph.parametertree import Parameter, ParameterTree, ParameterItem, reg
 from pydcam.dcam_reader import DCamReader, DCamSim
 from pydcam.dcam_display import ImageUpdater
 from pydcam.dcam_saver import CamSaver
-from pydcam import open_config
+from pydcam import open_config, reader_args
 
 class ConsoleLog(QtW.QMainWindow):
     writeSig = QtC.pyqtSignal(str)
@@ -117,7 +117,7 @@ class ControlWindow(QtW.QWidget):
 
 
         self.camreader = reader
-        self.camsaver = CamSaver(self.camreader.get_image,self.camreader.get_images,self.camreader.get_exposure)
+        self.camsaver = CamSaver(self.camreader.get_image,self.camreader.get_images,self.camreader.get_exposure,self.camreader.register_callback,self.camreader.snapshot)
         self.camsaver.set_can_save(self.camreader.get_running)
 
         self.camreader.camera.set_fps_cb(self.camfps_signal.emit)
@@ -284,11 +284,9 @@ class ControlWindow(QtW.QWidget):
 if __name__ == "__main__":
 
     from pydcam.api import OpenCamera
-    from pathlib import Path
 
-    fname = None
-    if len(sys.argv) > 1:
-        fname = Path(sys.argv[1]).resolve()
+    args = reader_args()
+    fname = args.config
 
     with OpenCamera(0) as dcam:
 
@@ -298,7 +296,7 @@ if __name__ == "__main__":
             if init_dict: dcam.prop_setfromdict(init_dict)
 
         app = QtW.QApplication(sys.argv)
-        reader = DCamReader(dcam)
+        reader = DCamReader(dcam, history=args.history, history_path=args.history_path)
         controlWin = ControlWindow(reader)
         controlWin.show()
         sys.exit(app.exec())
@@ -16,8 +16,10 @@ import pydcam.api.dcam_extra as dapi
 import time
 import threading
 import numpy
-from pydcam.utils.numpy_circ_buf import thread_buf
+from pydcam.utils.numpy_circ_buf import thread_buf, seq_buf
+from pydcam.utils.recorder import snapshot
 from pydcam.utils.cb_thread import CallbackThread
+from pydcam.utils.sim_scene import sim_scene
 
 
 def my_wait(secs,start_time=None):
@@ -28,6 +30,19 @@ def my_wait(secs,start_time=None):
         if waittime > 0:
             time.sleep(waittime)
 
+def dcam_seconds(timestamp:DCAM_TIMESTAMP):
+    return timestamp.sec + timestamp.microsec*1e-6
+
+def wait_until(deadline, spin=0.0005):
+    """Sleep until deadline (a perf_counter time), spinning for the last spin seconds as
+    sleep() alone overshoots by too much for short frame periods"""
+    while True:
+        left = deadline - time.perf_counter()
+        if left <= 0:
+            return
+        if left > spin:
+            time.sleep(left - spin)
+
 def busy_wait(secs,start_time=None):
     if start_time is None:
         # time.sleep(secs)
@@ -36,22 +51,43 @@ def busy_wait(secs,start_time=None):
         pass
 
 class pub_thread(CallbackThread):
-    def __init__(self, src_buf:thread_buf, ratelimit=0):
-        super().__init__(startpaused=True, ratelimit=ratelimit)
+    def __init__(self, src_buf:thread_buf, ratelimit=0, name="publisher", policy="drop", lease=False, threaded=False):
+        super().__init__(startpaused=True, ratelimit=ratelimit, threaded=threaded)
         self.src_buf = src_buf
+        # our own read position so other readers of src_buf don't steal frames
+        self.reader = src_buf.add_reader(name, policy)
+        # pass the callbacks a read-only view of the buffer slot instead of a copy,
+        # callbacks that keep the data must copy it
+        self.lease = lease and hasattr(src_buf, "leases")
+        self.current_lease = None
 
     def get_data(self):
-        return self.src_buf.get_latest(block=1, copy=1)
+        if self.lease:
+            self.current_lease = self.reader.lease(block=1)
+            if self.current_lease is not None:
+                return self.current_lease.data
+            return None
+        return self.reader.get_latest(block=1, copy=1)
+
+    def release_data(self, cb_data):
+        if self.current_lease is not None:
+            self.current_lease.release()
+            self.current_lease = None
 
     def stop(self):
         super().stop()
         self.src_buf.cancel_wait()
 
 class cam_thread(threading.Thread):
-    def __init__(self, dcam:Dcam, dst_buf:thread_buf):
+    def __init__(self, dcam:Dcam, dst_buf:thread_buf, attach=False):
         super().__init__()
         self.dcam = dcam
         self.dst_buf = dst_buf
+        self.counters = dst_buf.counters
+
+        # in attach mode the camera writes straight into dst_buf.bufs
+        self.attach = attach
+        self.frame_count = 0
 
         self.go = True
         self._pause = True
@@ -91,7 +127,11 @@ class cam_thread(threading.Thread):
             if retval is False:
                 if self.dcam.lasterr() == DCAMERR.ABORT:
                     print("received the abort signal")
+                elif self.dcam.lasterr() == DCAMERR.TIMEOUT:
+                    self.counters.wait_timeouts += 1
+                    print(f"ERROR in wait_again() -> {self.dcam.lasterr().name}")
                 else:
+                    self.counters.wait_errors += 1
                     print(f"ERROR in wait_again() -> {self.dcam.lasterr().name}")
                 continue
         
@@ -110,15 +150,26 @@ class cam_thread(threading.Thread):
             # else:
             #     self.dst_buf.inc_last_filled()
 
-            # get frame with dcam lockframe
-            arr = self.dcam.buf_getpointer(-1)
-            if arr is False:
-                print(f"Error in buf_getlastframedata() - > {self.dcam.lasterr().name}")
-                continue
-            try:
-                self.dst_buf.copy_from_address(arr.buf, arr.rowbytes*arr.height)
-            except Exception as e:
-                print(e)
+            if self.attach:
+                # frame is already in dst_buf, just find out where
+                info = self.dcam.cap_transferinfo()
+                if info is False:
+                    self.counters.copy_failures += 1
+                    print(f"Error in cap_transferinfo() - > {self.dcam.lasterr().name}")
+                    continue
+                n = info.nFrameCount - self.frame_count
+                if n > 0:
+                    self.frame_count = info.nFrameCount
+                    self.counters.captured += n
+                    # lockframe on an attached buffer only fetches the frame info
+                    frame = self.dcam.buf_getpointer(info.nNewestFrameIndex)
+                    if frame is False:
+                        self.dst_buf.mark_filled(info.nNewestFrameIndex, n)
+                    else:
+                        self.counters.check_framestamp(frame.framestamp, n)
+                        self.dst_buf.mark_filled(info.nNewestFrameIndex, n, frame.framestamp, dcam_seconds(frame.timestamp))
+            else:
+                self.copy_frame()
 
             now = time.time()
             try:
@@ -130,6 +181,23 @@ class cam_thread(threading.Thread):
                     self.fps_cb(self.fps)
             lastupdate = now
 
+    def copy_frame(self):
+        # get frame with dcam lockframe
+        arr = self.dcam.buf_getpointer(-1)
+        if arr is False:
+            self.counters.copy_failures += 1
+            print(f"Error in buf_getlastframedata() - > {self.dcam.lasterr().name}")
+            return
+        self.counters.captured += 1
+        self.counters.check_framestamp(arr.framestamp)
+        try:
+            ret = self.dst_buf.copy_from_address(arr.buf, arr.rowbytes*arr.height, arr.framestamp, dcam_seconds(arr.timestamp))
+        except Exception as e:
+            print(e)
+            ret = None
+        if ret is None:
+            self.counters.copy_failures += 1
+
     def pause(self):
         self.wait_while_paused.clear()
         self._pause = True
@@ -137,6 +205,9 @@ class cam_thread(threading.Thread):
         self.wait_until_paused.wait()
 
     def unpause(self):
+        # DCAM restarts nFrameCount and the framestamp with every cap_start
+        self.frame_count = 0
+        self.counters.restart()
         self.wait_while_paused.set()
 
     def stop(self):
@@ -145,10 +216,22 @@ class cam_thread(threading.Thread):
         self.dcam.wait_abort()
 
 class cam_sim(threading.Thread):
-    def __init__(self, dst_buf, im_size=(200,200)):
+    """A simulated camera thread, frames from a sim_scene at a steady rate.
+
+    The frame period is 1/fps, or the exposure time if fps isn't set. Frames are paced on
+    perf_counter deadlines (sleep, then spin for the last bit) so rates of thousands of
+    fps hold. Faults can be injected for load testing, they show up as framestamp gaps
+    like they would with a real camera:
+        drop_prob: chance a frame is never delivered
+        jitter: std deviation (s) of the extra delay delivering a frame
+        stall_prob, stall_time: chance a frame stalls the camera for stall_time seconds,
+            the frames that should have come in the meantime are lost
+    The other keyword arguments go to sim_scene (bits, noise, sources, hot pixels...)"""
+    def __init__(self, dst_buf, im_size=(200,200), fps=None, drop_prob=0., jitter=0., stall_prob=0., stall_time=0.1, seed=None, spin=0.0005, **scene_options):
         super().__init__()
 
         self.dst_buf = dst_buf
+        self.counters = dst_buf.counters
 
         self.go = True
         self._pause = True
@@ -156,8 +239,19 @@ class cam_sim(threading.Thread):
         self.fps_cb = None
 
         self.exptime = 1 
+        self.fps = None
+        self.target_fps = fps
+
+        self.drop_prob = drop_prob
+        self.jitter = jitter
+        self.stall_prob = stall_prob
+        self.stall_time = stall_time
+        self.spin = spin
+        self.rng = numpy.random.default_rng(seed)
+        self.scene_options = dict(scene_options, seed=seed)
 
         self.imsize = im_size
+        self.restart = True
 
         self.wait = threading.Event()
 
@@ -170,39 +264,54 @@ class cam_sim(threading.Thread):
         if callable(func):
             self.fps_cb = func
 
-    def run(self):
+    def period(self):
+        return 1/self.target_fps if self.target_fps else self.exptime
 
-        lastupdate = time.time()
+    def run(self):
 
         self.resize(self.imsize)
-        cnt = 0
-        now = time.time()
         while(self.go):
             # wait image
             if self._pause:
                 self.wait_until_paused.set()
                 self.wait_while_paused.wait()
                 self.wait_until_paused.clear()
-            my_wait(self.exptime, now)
-            now = time.time()
-            # print("got frame...")
-            temp = self.temp[cnt%100]
-            temp[:,(cnt)%self.imsize[1]] = 2500
-            # self.dst_buf.copy_numpy(temp)
-            self.dst_buf.copy_from_address(temp.ctypes.data_as(c_void_p), temp.nbytes)
-            # try:
-            #     self.dcam.buf_getframe_withnp(-1,self.dst_buf.get_to_fill())
-            # except Exception as e:
-            #     print(e)
-            # else:
-            #     self.dst_buf.inc_last_filled()
+            if not self.go:
+                break
+            if self.restart:
+                self.restart = False
+                framestamp = 0
+                start = next_time = lastupdate = time.perf_counter()
+            period = self.period()
+            next_time += period
+            # the frame is ready at the end of its exposure, make it while "exposing"
+            frame = self.frame
+            self.scene.render(next_time - start, frame, framestamp)
+            deadline = next_time
+            if self.jitter:
+                deadline += abs(self.rng.normal(0, self.jitter))
+            if self.stall_prob and self.rng.random() < self.stall_prob:
+                deadline += self.stall_time
+            wait_until(deadline, self.spin)
+            now = time.perf_counter()
+            late = int((now - next_time)/period)
+            if late > 0:
+                # stalled or can't keep up, the frames that should have come since are lost
+                framestamp += late
+                next_time += late*period
+            stamp = framestamp
+            framestamp += 1
+            if self.drop_prob and self.rng.random() < self.drop_prob:
+                continue
+            self.counters.captured += 1
+            self.counters.check_framestamp(stamp)
+            if self.dst_buf.copy_from_address(frame.ctypes.data_as(c_void_p), frame.nbytes, stamp, next_time - start) is None:
+                self.counters.copy_failures += 1
 
-            now2 = time.time()
-            self.fps = 1/(now2-lastupdate)
+            self.fps = 1/max(now-lastupdate, 1e-9)
             if self.fps_cb is not None:
                 self.fps_cb(self.fps)
-            lastupdate = now2
-            cnt += 1
+            lastupdate = now
 
     def pause(self):
         self.wait_while_paused.clear()
@@ -210,22 +319,45 @@ class cam_sim(threading.Thread):
         self.wait_until_paused.wait()
 
     def unpause(self):
+        # like DCAM the framestamp starts again with every capture
+        self.restart = True
+        self.counters.restart()
         self.wait_while_paused.set()
 
     def stop(self):
         self.go = False
         self.unpause()
 
-    def resize(self,imdim,n=100):
+    def resize(self,imdim):
         self.imsize = imdim
-        self.temp = ((numpy.random.random(n*numpy.prod(self.imsize))+0.1)*2000).astype(numpy.int16).reshape((n,*self.imsize))
+        self.scene = sim_scene(imdim, **self.scene_options)
+        self.frame = numpy.empty(imdim, dtype=self.scene.dtype)
 
 
 class DCamReader():
-    def __init__(self, dcam:Dcam):
+    def __init__(self, dcam:Dcam, attach=False, lockfree=False, lease=False, threaded=False, history=10, history_path=None):
 
         self.dcam = dcam
 
+        # attach the thread_buf frames to the camera instead of copying from a DCAM buffer
+        self.attach = attach
+        # use the lock free seq_buf, it can't be used in attach mode
+        if attach and lockfree:
+            print("Can't use the lock free buffer in attach mode, using thread_buf")
+            lockfree = False
+        self.buf_type = seq_buf if lockfree else thread_buf
+        # the camera writes into the attached frames whatever is leased, so a lease can't hold it off
+        if attach and lease:
+            print("Can't lease frames in attach mode, publishing copies")
+            lease = False
+        # publish leased views of the buffer instead of copies (thread_buf only)
+        self.lease = lease
+        # run each callback in its own thread so a slow one doesn't hold up the others
+        self.threaded = threaded
+        # number of frames kept in the buffer, with history_path they're kept in a memory mapped file
+        self.history = history
+        self.history_path = history_path
+
         # show device information
         self.dcamdev_info = dapi.dcamcon_show_dcamdev_info( self.dcam )
 
@@ -247,9 +379,9 @@ class DCamReader():
             sys.exit()
         dtype = "uint16" if pxltype == 2 else "uint8"
         print("dtype = ",dtype,pxltype)
-        self.buffers = thread_buf(shape, 10, dtype)
-        self.publisher = pub_thread(self.buffers)
-        self.camera = cam_thread(self.dcam, self.buffers)
+        self.buffers = self.buf_type(shape, self.history, dtype, path=self.history_path)
+        self.publisher = pub_thread(self.buffers, lease=self.lease, threaded=self.threaded)
+        self.camera = cam_thread(self.dcam, self.buffers, attach=self.attach)
 
         self.publisher.start()
         self.camera.start()
@@ -263,21 +395,30 @@ class DCamReader():
         shape = (int(height),int(width))
         if framebytes != width*height*pxltype:
             print(f"ERROR in buffer init -> {framebytes} != {width*height*pxltype}")
-            return 
+            return False
         dtype = "uint16" if pxltype == 2 else "uint8"
         print("dtype = ",dtype,pxltype)
 
         self.buffers.resize(shape, None, dtype)
+        return True
 
     def open_camera(self):
         # start capture
-        err = self.dcam.buf_alloc(3)
+        if self.attach:
+            if not self.resize_thread_buffer():
+                return
+            err = self.dcam.buf_attach(self.buffers.bufs)
+            if err is False:
+                print(f"ERROR in buf_attach() -> {self.dcam.lasterr().name}" )
+                return
+        else:
+            err = self.dcam.buf_alloc(3)
 
-        if err is False:
-            print(f"ERROR in buf_alloc() -> {self.dcam.lasterr().name}" )
-            return
+            if err is False:
+                print(f"ERROR in buf_alloc() -> {self.dcam.lasterr().name}" )
+                return
 
-        self.resize_thread_buffer()
+            self.resize_thread_buffer()
 
         bufinfo = self.dcam.buf_get_info()
         print("BUFINFO:",bufinfo.width,bufinfo.height)
@@ -426,9 +567,9 @@ class DCamReader():
     def set_publish(self,value=True):
         self.publisher.set_zmq(value)
 
-    def register_callback(self, func):
-        pass
-        return self.publisher.register(func)
+    def register_callback(self, func, **kwargs):
+        """kwargs are passed to CallbackThread.register, e.g. max_rate, every_nth, roi"""
+        return self.publisher.register(func, **kwargs)
 
     def deregister_callback(self, fid):
         self.publisher.deregister(fid)
@@ -436,8 +577,13 @@ class DCamReader():
     def get_image(self):
         return self.publisher.oneshot()
 
-    def get_images(self,n=1):
-        return self.publisher.multishot(n)
+    def get_images(self,n=1,out=None):
+        """n consecutive frames in one array, see CallbackThread.multishot_into"""
+        return self.publisher.multishot_into(n, out)
+
+    def snapshot(self, recorders, seconds=None, frames=None, after=0, policy="drop"):
+        """Save the frames of the last seconds (or frames) in the buffer and the next after frames, see recorder.snapshot"""
+        return snapshot(self.buffers, recorders, seconds, frames, after, policy)
 
     def get_window_info(self):
         ids = [ DCAM_IDPROP.SUBARRAYHSIZE, DCAM_IDPROP.SUBARRAYHPOS, DCAM_IDPROP.SUBARRAYVSIZE, DCAM_IDPROP.SUBARRAYVPOS, DCAM_IDPROP.EXPOSURETIME ]
@@ -461,13 +607,41 @@ class DCamReader():
     def reset_buffer_head(self):
         self.buffers.reset_head()
 
+    def get_counters(self):
+        return self.buffers.counters.snapshot()
+
+    def add_reader(self, name, policy="drop"):
+        """A named read position in the buffer, see buf_reader"""
+        return self.buffers.add_reader(name, policy)
+
+    def remove_reader(self, name):
+        self.buffers.remove_reader(name)
+
+    def get_reader_stats(self):
+        return self.buffers.reader_stats()
+
+    def reset_counters(self):
+        self.buffers.counters.reset()
+
 class DCamSim():
-    def __init__(self):
+    """The DCamReader interface on a simulated camera. fps, bits and the sim_options
+    (fault injection and scene, see cam_sim and sim_scene) set up the simulator, e.g.
+        DCamSim(fps=2000, shape=(128,128), bits=12, drop_prob=0.001, sources=5)"""
+    def __init__(self, lockfree=False, lease=False, threaded=False, history=10, history_path=None, fps=None, shape=(1024,1024), bits=16, **sim_options):
+
+        self.buf_type = seq_buf if lockfree else thread_buf
+        self.lease = lease
+        self.threaded = threaded
+        self.history = history
+        self.history_path = history_path
+        self.fps = fps
+        self.bits = bits
+        self.dtype = "uint8" if bits <= 8 else "uint16"
+        self.sim_options = sim_options
 
         # set these as default values
         self.exposure = 1.0
-        self.hsize = 1024
-        self.vsize = 1024
+        self.vsize, self.hsize = shape
         self.hpos = 512
         self.vpos = 512
 
@@ -477,27 +651,15 @@ class DCamSim():
 
         self.running = 0
 
-    def thread_buffer_init(self,imdim):
-
-        buf_size = int(imdim[0]*imdim[1]*2)
-
-        self.buffers = thread_buf(buf_size, 10, 16, imdim)
-        self.publisher = pub_thread(self.buffers)
-        self.camera = cam_sim(self.buffers,im_size=imdim)
-
-        self.publisher.start()
-        self.camera.start()
-        
     def thread_buffer_init(self):
 
         width = self.hsize
         height = self.vsize
         shape = (int(height),int(width))
-        dtype = "uint16"
 
-        self.buffers = thread_buf(shape, 10, dtype)
-        self.publisher = pub_thread(self.buffers)
-        self.camera = cam_sim(self.buffers, im_size=shape)
+        self.buffers = self.buf_type(shape, self.history, self.dtype, path=self.history_path)
+        self.publisher = pub_thread(self.buffers, lease=self.lease, threaded=self.threaded)
+        self.camera = cam_sim(self.buffers, im_size=shape, fps=self.fps, bits=self.bits, **self.sim_options)
 
         self.publisher.start()
         self.camera.start()
@@ -507,9 +669,8 @@ class DCamSim():
         width = self.hsize
         height = self.vsize
         shape = (int(height),int(width))
-        dtype = "uint16"
 
-        self.buffers.resize(shape, None, dtype)
+        self.buffers.resize(shape, None, self.dtype)
 
     def open_camera(self):
         # start capture
@@ -551,6 +712,15 @@ class DCamSim():
     def set_exposure(self,exp_time):
         self.camera.exptime = exp_time
 
+    def get_exposure(self):
+        # the exposure can't be longer than the frame period set by the frame rate
+        return min(self.camera.exptime, self.camera.period())
+
+    def set_frame_rate(self, fps):
+        """Run at fps instead of 1/exposure, None to go back to the exposure time"""
+        self.fps = fps
+        self.camera.target_fps = fps
+
     def set_subarray(self, hsize, vsize, hpos, vpos):
 
         self.hsize = hsize
@@ -565,8 +735,8 @@ class DCamSim():
     def set_publish(self,value=True):
         self.publisher.set_zmq(value)
 
-    def register_callback(self, func):
-        return self.publisher.register(func)
+    def register_callback(self, func, **kwargs):
+        return self.publisher.register(func, **kwargs)
 
     def deregister_callback(self, fid):
         self.publisher.deregister(fid)
@@ -574,17 +744,22 @@ class DCamSim():
     def get_image(self):
         return self.publisher.oneshot()
 
-    def get_images(self,n=1):
-        return self.publisher.multishot(n)
+    def get_images(self,n=1,out=None):
+        """n consecutive frames in one array, see CallbackThread.multishot_into"""
+        return self.publisher.multishot_into(n, out)
+
+    def snapshot(self, recorders, seconds=None, frames=None, after=0, policy="drop"):
+        """Save the frames of the last seconds (or frames) in the buffer and the next after frames, see recorder.snapshot"""
+        return snapshot(self.buffers, recorders, seconds, frames, after, policy)
 
     def get_window_info(self):
         keys = ["SUBARRAY HSIZE","SUBARRAY HPOS","SUBARRAY VSIZE","SUBARRAY VPOS","EXPOSURE TIME"]
-        values = [(self.camera.imsize[0],0,2000),(2,1,3),(self.camera.imsize[1],0,2000),(2,1,3),(self.camera.exptime,0,10)]
+        values = [(self.camera.imsize[0],0,2000),(2,1,3),(self.camera.imsize[1],0,2000),(2,1,3),(self.get_exposure(),0,10)]
         return values
 
     def get_window_info_dict(self):
         keys = ["SUBARRAYHSIZE","SUBARRAYHPOS","SUBARRAYVSIZE","SUBARRAYVPOS","EXPOSURETIME"]
-        values = [(self.camera.imsize[0],0,2000),(2,1,3),(self.camera.imsize[1],0,2000),(2,1,3),(self.camera.exptime,0,10)]
+        values = [(self.camera.imsize[0],0,2000),(2,1,3),(self.camera.imsize[1],0,2000),(2,1,3),(self.get_exposure(),0,10)]
         return dict(zip(keys,values))
 
     def get_running(self):
@@ -593,6 +768,22 @@ class DCamSim():
     def reset_buffer_head(self):
         self.buffers.reset_head()
 
+    def get_counters(self):
+        return self.buffers.counters.snapshot()
+
+    def add_reader(self, name, policy="drop"):
+        """A named read position in the buffer, see buf_reader"""
+        return self.buffers.add_reader(name, policy)
+
+    def remove_reader(self, name):
+        self.buffers.remove_reader(name)
+
+    def get_reader_stats(self):
+        return self.buffers.reader_stats()
+
+    def reset_counters(self):
+        self.buffers.counters.reset()
+
 
 if __name__ == "__main__":
     from pydcam import open_config
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+    Headless recording
+    ================
+    Records from the camera (or the simulator) straight to HDF5, FITS and/or raw files with the
+    streaming recorders, no Qt needed.
+
+        pydcam-record config.toml -o run1.hdf5 -n 10000
+        pydcam-record --sim -o run1 --format fits --format raw -t 60 --exposure 0.01
+        pydcam-record -o run1.raw          (records until ctrl-C or SIGTERM)
+"""
+import argparse
+import datetime
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+from pydcam.utils.recorder import hdf5_recorder, fits_recorder, raw_recorder, writer_pool
+
+RECORDERS = {
+    "hdf5": hdf5_recorder,
+    "fits": fits_recorder,
+    "raw": raw_recorder,
+}
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="pydcam-record", description="Record frames to disk without the GUI")
+    parser.add_argument("config", nargs="?", help="camera config file (toml, yaml or json)")
+    parser.add_argument("-o", "--output", help="output file name, the extension picks the format if --format isn't given")
+    parser.add_argument("-f", "--format", action="append", choices=list(RECORDERS), help="file format, can be repeated")
+    parser.add_argument("-n", "--frames", type=int, help="number of frames to record")
+    parser.add_argument("-t", "--seconds", type=float, help="how long to record for")
+    parser.add_argument("-e", "--exposure", type=float, help="exposure time in seconds")
+    parser.add_argument("--sim", action="store_true", help="use the simulated camera")
+    parser.add_argument("--fps", type=float, help="simulator frame rate, 1/exposure if not given")
+    parser.add_argument("--device", type=int, default=0, help="camera index")
+    parser.add_argument("--queue-size", type=int, default=64, help="frames queued per file before frames are dropped")
+    parser.add_argument("--compression", default=None, help="HDF5 compression, gzip, lzf, ...")
+    parser.add_argument("--chunks", type=int, default=None, help="HDF5 frames per chunk")
+    parser.add_argument("--report", type=float, default=1., help="seconds between progress lines, 0 for none")
+    return parser
+
+def output_files(output, formats):
+    """{format: file name} from the output name and the chosen formats"""
+    if output is None:
+        output = "pydcam_" + datetime.datetime.now().isoformat(timespec='seconds').replace(":","-")
+    path = Path(output)
+    ext = path.suffix.lstrip(".").lower()
+    if ext in RECORDERS:
+        path = path.with_suffix("")
+        if not formats:
+            formats = [ext]
+    if not formats:
+        formats = ["hdf5"]
+    return {fmt:f"{path}.{fmt}" for fmt in dict.fromkeys(formats)}
+
+def make_recorders(files, nframes=None, exposure=0., queue_size=64, compression=None, chunks=None, timeout=0.):
+    """The recorders for files, with timeout=0 a full queue drops the frame for that file straight
+    away rather than holding up the publisher (and so every other file)"""
+    recorders = []
+    for fmt, fname in files.items():
+        if fmt == "hdf5":
+            recorders.append(hdf5_recorder(fname, nframes, queue_size, exposure, timeout, compression=compression, chunks=chunks))
+        else:
+            recorders.append(RECORDERS[fmt](fname, nframes, queue_size, exposure, timeout))
+    return recorders
+
+def progress(pool, nframes=None):
+    """pool.status with the frames dropped by each file"""
+    ret = pool.status(nframes)
+    if pool.dropped:
+        ret += " (" + ", ".join(f"{Path(rec.fname).suffix.lstrip('.')}: {rec.dropped}" for rec in pool.recorders) + ")"
+    return ret
+
+def record(camreader, recorders, nframes=None, seconds=None, stop=None, report=1.):
+    """Record with the recorders until nframes are written, seconds have passed or stop is set.
+    Returns the writer_pool for its statistics"""
+    pool = writer_pool(recorders)
+    pool.start()
+    start = time.perf_counter()
+    camreader.register_callback(pool.append)
+    last = start
+    while not pool.wait(0.1):
+        now = time.perf_counter()
+        if (stop is not None and stop.is_set()) or (seconds is not None and now - start >= seconds):
+            pool.finish()
+            break
+        if report and now - last >= report:
+            print(progress(pool, nframes), flush=True)
+            last = now
+    pool.elapsed = time.perf_counter() - start
+    return pool
+
+def summary(pool, camreader):
+    written = pool.written
+    rate = written/pool.elapsed if pool.elapsed else 0.
+    lines = [f"Wrote {written} frames in {pool.elapsed:.1f}s ({rate:.1f} fps, {rate*camreader.buffers.size/1e6:.1f} MB/s per file)"]
+    for rec in pool.recorders:
+        line = f"  {rec.fname}: {rec.written} frames, {rec.rate():.1f} fps, dropped {rec.dropped}"
+        if rec.error is not None:
+            line += f", failed: {rec.error}"
+        lines.append(line)
+    lines.append(f"Camera: {camreader.buffers.counters}")
+    return "\n".join(lines)
+
+def open_reader(args, dcam=None):
+    if dcam is None:
+        from pydcam.dcam_reader import DCamSim
+        camreader = DCamSim(fps=args.fps)
+    else:
+        from pydcam.dcam_reader import DCamReader
+        camreader = DCamReader(dcam)
+    if args.exposure is not None:
+        camreader.set_exposure(args.exposure)
+    return camreader
+
+def run(args, camreader):
+    stop = threading.Event()
+    def handler(signum, frame):
+        print("Stopping...", flush=True)
+        stop.set()
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+    files = output_files(args.output, args.format)
+    camreader.open_camera()
+    recorders = make_recorders(files, args.frames, camreader.get_exposure(), args.queue_size, args.compression, args.chunks)
+    print("Recording to " + ", ".join(files.values()), flush=True)
+    try:
+        pool = record(camreader, recorders, args.frames, args.seconds, stop, args.report)
+    finally:
+        camreader.quit()
+    print(summary(pool, camreader))
+    return 1 if pool.errors() else 0
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.frames is None and args.seconds is None:
+        print("No --frames or --seconds, recording until ctrl-C")
+    config = None
+    if args.config is not None:
+        from pydcam import open_config
+        config = open_config(Path(args.config).resolve())
+        if config is None:
+            return 1
+    if args.sim:
+        if config:
+            print("Not applying the config to the simulator")
+        return run(args, open_reader(args))
+
+    from pydcam.api import OpenCamera
+    with OpenCamera(args.device) as dcam:
+        if dcam is None:
+            print("No camera found")
+            return 1
+        dcam.prop_setdefaults()
+        if config:
+            dcam.prop_setfromdict(config)
+        return run(args, open_reader(args, dcam))
+
+if __name__ == "__main__":
+    sys.exit(main())
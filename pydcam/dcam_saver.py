@@ -22,6 +22,10 @@ from pathlib import Path
 from pydcam.dcam_display import ImageDisplay
 from pydcam.utils.zmq_pubsub import zmq_reader
 from pydcam.utils.runnable import MyRunnable
+from pydcam.utils.recorder import hdf5_recorder, raw_recorder, fits_recorder, writer_pool, RecorderDone, save_images
+from pydcam.utils.recorder import available_hdf5_compression, hdf5_filter_args, chunk_shape
+from pydcam.utils.frame_source import frame_source, open_frames
+from pydcam.utils.timelapse import timelapse
 
 get_now = partial(datetime.datetime.now, timezone.utc)
 
@@ -41,13 +45,15 @@ def list_to_numpy(imlist):
         for i,img in enumerate(imlist):
             x[i] = img
         return x
-    elif type(imlist) is numpy.ndarray:
+    elif isinstance(imlist, numpy.ndarray):
         return imlist
     else:
         raise TypeError("list_to_numpy: Type not understood")
 
 class ImageViewer(QtW.QWidget):
-    def __init__(self):
+    """Steps through a recording one frame at a time, frames come from a frame_source
+    so only the frames shown (and a few prefetched ahead when playing) are read"""
+    def __init__(self, fps=10, prefetch=4):
         super().__init__()
         self.resize(800,600)
         self.mainlayout = QtW.QVBoxLayout()
@@ -57,10 +63,21 @@ class ImageViewer(QtW.QWidget):
         self.mainlayout.addWidget(self.image)
 
         self.controlbar = QtW.QWidget()
-        self.buttonlayout = QtW.QHBoxLayout()
-        self.controlbar.setLayout(self.buttonlayout)
+        self.controllayout = QtW.QVBoxLayout()
+        self.controlbar.setLayout(self.controllayout)
         self.mainlayout.addWidget(self.controlbar)
 
+        self.framelayout = QtW.QHBoxLayout()
+        self.frameslider = QtW.QSlider(QtC.Qt.Horizontal)
+        self.frameslider.valueChanged.connect(self.show_frame)
+        self.framelabel = QtW.QLabel()
+        self.framelayout.addWidget(self.frameslider)
+        self.framelayout.addWidget(self.framelabel)
+        self.controllayout.addLayout(self.framelayout)
+
+        self.buttonlayout = QtW.QHBoxLayout()
+        self.controllayout.addLayout(self.buttonlayout)
+
         self.firstbutton = QtW.QPushButton("First")
         self.firstbutton.clicked.connect(self.first_callback)
         self.buttonlayout.addWidget(self.firstbutton)
@@ -82,55 +99,87 @@ class ImageViewer(QtW.QWidget):
         self.lastbutton.clicked.connect(self.last_callback)
         self.buttonlayout.addWidget(self.lastbutton)
 
+        self.playtimer = QtC.QTimer()
+        self.playtimer.setInterval(int(1000/fps))
+        self.playtimer.timeout.connect(self.play_step)
+        self.prefetch = prefetch
+
+        self.source = None
+        self.image_count = 0
+        self.index = 0
+
     def update(self,data):
+        """Show a frame_source, or a 2D/3D array"""
+        self.playpausebutton.setChecked(False)
+        if self.source is not None and self.source is not data:
+            self.source.close()
+        if not isinstance(data, frame_source):
+            data = frame_source(data)
+        self.source = data
+        self.image_count = len(data)
+        self.index = 0
+        self.frameslider.blockSignals(True)
+        self.frameslider.setRange(0, self.image_count-1)
+        self.frameslider.setValue(0)
+        self.frameslider.blockSignals(False)
+        self.controlbar.setVisible(self.image_count > 1)
         self.image.relimitimage()
-        if len(data.shape) == 3:
-            self.image_count = data.shape[0]
-            # self.image.setImage(numpy.transpose(data,axes=(0,2,1)),xvals=numpy.arange(self.image_count)+1)
-            self.image.old_update(numpy.transpose(data,axes=(0,2,1)))
-            self.controlbar.show()
-        else:
-            self.image_count = 1
-            # self.image.setImage(data.T)
-            self.image.old_update(data.T)
-            self.controlbar.hide()
+        self.show_frame(0)
+
+    def show_frame(self, index):
+        if self.source is None:
+            return
+        self.index = index % self.image_count
+        frame = self.source[self.index]
+        self.image.old_update(frame.T)
+        self.framelabel.setText(f"{self.index+1}/{self.image_count}")
+        if self.frameslider.value() != self.index:
+            self.frameslider.blockSignals(True)
+            self.frameslider.setValue(self.index)
+            self.frameslider.blockSignals(False)
 
     def first_callback(self):
         self.image.relimitimage()
-        self.image.image.setCurrentIndex(0)
+        self.show_frame(0)
 
     def prev_callback(self):
-        currind = self.image.image.currentIndex
-        if currind==0:
-            self.last_callback()
-        else:
-            self.image.relimitimage()
-            self.image.image.jumpFrames(-1)
+        self.image.relimitimage()
+        self.show_frame(self.index-1)
 
     def next_callback(self):
-        currind = self.image.image.currentIndex
-        if currind>=self.image_count-1:
-            self.first_callback()
-        else:
-            self.image.relimitimage()
-            self.image.image.jumpFrames(+1)
+        self.image.relimitimage()
+        self.show_frame(self.index+1)
 
     def last_callback(self):
         self.image.relimitimage()
-        self.image.image.setCurrentIndex(self.image_count-1)
+        self.show_frame(self.image_count-1)
+
+    def play_step(self):
+        self.show_frame(self.index+1)
+        self.source.prefetch(*range(self.index+1, self.index+1+self.prefetch))
 
     def playpause_callback(self, event):
-        if event:
-            self.image.image.play(1)
+        if event and self.source is not None:
+            self.source.prefetch(*range(self.index+1, self.index+1+self.prefetch))
+            self.playtimer.start()
         else:
-            self.image.image.play(0)
+            self.playtimer.stop()
+
+    def closeEvent(self, event):
+        self.playpausebutton.setChecked(False)
+        super().closeEvent(event)
 
 class CamSaver(QtW.QWidget):
-    def __init__(self, get_one_func, get_multi_func=None, get_exp_func=None):
+    statusSig = QtC.pyqtSignal(str)
+    def __init__(self, get_one_func, get_multi_func=None, get_exp_func=None, register_func=None, snapshot_func=None):
         super().__init__()
         self.get_one_callback = get_one_func
         self.get_multiple_callback = get_multi_func
         self.get_exp_func = get_exp_func
+        # registers a callback for new frames, used to stream images to disk as they arrive
+        self.register_func = register_func
+        # saves what's already in the camera buffer, see DCamReader.snapshot
+        self.snapshot_func = snapshot_func
 
         self.mainlayout = QtW.QVBoxLayout()
         self.setLayout(self.mainlayout)
@@ -142,12 +191,16 @@ class CamSaver(QtW.QWidget):
         self.savefitscheck = QtW.QCheckBox()
         self.savehdf5label = QtW.QLabel("HDF5:")
         self.savehdf5check = QtW.QCheckBox()
+        self.saverawlabel = QtW.QLabel("RAW:")
+        self.saverawcheck = QtW.QCheckBox()
 
         self.savechecklayout = QtW.QHBoxLayout()
         self.savechecklayout.addWidget(self.savefitslabel)
         self.savechecklayout.addWidget(self.savefitscheck)
         self.savechecklayout.addWidget(self.savehdf5label)
         self.savechecklayout.addWidget(self.savehdf5check)
+        self.savechecklayout.addWidget(self.saverawlabel)
+        self.savechecklayout.addWidget(self.saverawcheck)
         self.savechecklayout.setContentsMargins(0,0,0,0)
         self.savebuttonlayout = QtW.QVBoxLayout()
         self.savebuttonlayout.addLayout(self.savechecklayout)
@@ -166,6 +219,8 @@ class CamSaver(QtW.QWidget):
         self.numberofimages.setValue(1)
         self.continouslabel = QtW.QLabel("Save Continuously:")
         self.continouscheck = QtW.QCheckBox()
+        self.streamlabel = QtW.QLabel("Stream to Disk:")
+        self.streamcheck = QtW.QCheckBox()
 
         self.timesteplabel = QtW.QLabel("Time Interval (s):")
         self.timestep = QtW.QDoubleSpinBox()
@@ -182,7 +237,29 @@ class CamSaver(QtW.QWidget):
         self.getexptimebutton = QtW.QPushButton("Get Exposure Time")
         self.getexptimebutton.clicked.connect(self.get_exp_time)
 
+        self.compressionlabel = QtW.QLabel("HDF5 compression:")
+        self.compressioncombo = QtW.QComboBox()
+        self.compressioncombo.addItems(["none"] + available_hdf5_compression())
+        self.chunkframeslabel = QtW.QLabel("Frames per chunk:")
+        self.chunkframes = QtW.QSpinBox()
+        self.chunkframes.setRange(1, 1000)
+        self.chunkframes.setValue(1)
+
+        self.snapshotbutton = QtW.QPushButton("Save Buffer")
+        self.snapshotbutton.clicked.connect(self.snapshotbutton_callback)
+        self.snapshotbeforelabel = QtW.QLabel("Seconds before:")
+        self.snapshotbefore = QtW.QDoubleSpinBox()
+        self.snapshotbefore.setRange(0, 3600)
+        self.snapshotbefore.setValue(1.0)
+        self.snapshotbefore.setToolTip("Only what the camera buffer still holds is saved, use --history/--history-path for a deeper buffer")
+        self.snapshotafterlabel = QtW.QLabel("Frames after:")
+        self.snapshotafter = QtW.QSpinBox()
+        self.snapshotafter.setRange(0, 1000000)
+        self.snapshotafter.setValue(0)
+
         self.statuslabel = QtW.QLabel("Initialising...")
+        # the saving is done in other threads, update the label through a signal
+        self.statusSig.connect(self.statuslabel.setText)
 
 
         self.savelayouttop = QtW.QHBoxLayout()
@@ -194,6 +271,9 @@ class CamSaver(QtW.QWidget):
         self.savelayoutmiddle.addWidget(self.numberofimages)
         self.savelayoutmiddle.addWidget(self.continouslabel)
         self.savelayoutmiddle.addWidget(self.continouscheck)
+        if self.register_func is not None:
+            self.savelayoutmiddle.addWidget(self.streamlabel)
+            self.savelayoutmiddle.addWidget(self.streamcheck)
         self.savelayoutmiddle.addWidget(self.timesteplabel)
         self.savelayoutmiddle.addWidget(self.timestep)
         self.savelayoutbottom = QtW.QHBoxLayout()
@@ -201,10 +281,22 @@ class CamSaver(QtW.QWidget):
         self.savelayoutbottom.addWidget(self.exptime)
         if self.get_exp_func is not None:
             self.savelayoutbottom.addWidget(self.getexptimebutton)
+        self.savelayoutbottom.addWidget(self.compressionlabel)
+        self.savelayoutbottom.addWidget(self.compressioncombo)
+        self.savelayoutbottom.addWidget(self.chunkframeslabel)
+        self.savelayoutbottom.addWidget(self.chunkframes)
 
         self.mainlayout.addLayout(self.savelayouttop)
         self.mainlayout.addLayout(self.savelayoutmiddle)
         self.mainlayout.addLayout(self.savelayoutbottom)
+        if self.snapshot_func is not None:
+            self.snapshotlayout = QtW.QHBoxLayout()
+            self.snapshotlayout.addWidget(self.snapshotbutton)
+            self.snapshotlayout.addWidget(self.snapshotbeforelabel)
+            self.snapshotlayout.addWidget(self.snapshotbefore)
+            self.snapshotlayout.addWidget(self.snapshotafterlabel)
+            self.snapshotlayout.addWidget(self.snapshotafter)
+            self.mainlayout.addLayout(self.snapshotlayout)
         self.mainlayout.addWidget(self.filenamepreview)
         self.mainlayout.addWidget(self.statuslabel)
 
@@ -212,7 +304,7 @@ class CamSaver(QtW.QWidget):
         self.openlastimagebutton = QtW.QPushButton("Open Previous Images")
         self.openlastimagebutton.clicked.connect(self.opendisplay)
         self.savelastimagebutton = QtW.QPushButton("Save Previous Images")
-        self.savelastimagebutton.clicked.connect(self.save_current_images)
+        self.savelastimagebutton.clicked.connect(self.savelast_callback)
         self.openfilebutton = QtW.QPushButton("Open Saved Images")
         self.openfilebutton.clicked.connect(self.openfile)
         self.opendisplaylayout.addWidget(self.openlastimagebutton)
@@ -238,19 +330,36 @@ class CamSaver(QtW.QWidget):
 
     def toggletimestep(self,value):
         self.timestep.setEnabled(not value)
+        self.streamcheck.setEnabled(value)
 
     def savebutton_callback(self,event):
         self.statuslabel.setText("Working...")
         saver = MyRunnable(self.saveimages)
         QtC.QThreadPool.globalInstance().start(saver)
 
+    def savelast_callback(self,event):
+        self.statuslabel.setText("Working...")
+        saver = MyRunnable(self.save_current_images)
+        QtC.QThreadPool.globalInstance().start(saver)
+
+    def snapshotbutton_callback(self,event):
+        # fix the frames to save now, the recorders then catch up in the background
+        recorders = self.make_recorders(self.timestamp(get_now()))
+        if not recorders:
+            self.statuslabel.setText("Choose a file type to save the buffer to")
+            return
+        pool = writer_pool(self.snapshot_func(recorders, seconds=self.snapshotbefore.value(), after=self.snapshotafter.value()))
+        self.statuslabel.setText("Saving buffer...")
+        saver = MyRunnable(partial(self.wait_for_pool, pool))
+        QtC.QThreadPool.globalInstance().start(saver)
+
     def set_can_save(self,func):
         if callable(func):
             self.can_save = func
 
     def saveimages(self):
         if not self.can_save():
-            self.statuslabel.setText("Can't save yet...")
+            self.statusSig.emit("Can't save yet...")
             return
         self.now = get_now()
         N = self.numberofimages.value()
@@ -258,11 +367,20 @@ class CamSaver(QtW.QWidget):
             return
         elif N == 1:
             self.images = self.get_one()
+        elif self.continouscheck.isChecked() and self.register_func is not None and self.streamcheck.isChecked():
+            self.stream_images(N)
+            return
         elif self.continouscheck.isChecked():
             images = self.get_multiple(N)
             self.images = list_to_numpy(images)
             print("Got images")
+        elif self.register_func is not None:
+            self.timelapse_images(N)
+            return
         else:
+            # the images are written while we wait for the next one
+            pool = writer_pool(self.make_recorders(self.timestamp(self.now), N, timeout=None))
+            pool.start()
             s = self.timestep.value()
             images = deque()
             now = time.time()
@@ -270,23 +388,97 @@ class CamSaver(QtW.QWidget):
                 my_wait(s,now)
                 images.append(self.get_one())
                 now = time.time()
+                if pool.recorders:
+                    try:
+                        pool.append(images[-1])
+                    except RecorderDone:
+                        # that was the last one
+                        pass
+                    self.statusSig.emit(f"Got {n+1}/{N} images, " + pool.status(N))
+            pool.finish(wait=False)
             self.images = list_to_numpy(images)
             print("Got images")
-        self.statuslabel.setText(f"Got {N} images")
+            self.wait_for_pool(pool, N)
+            return
+        self.statusSig.emit(f"Got {N} images")
         self.save_current_images(now=self.now)
 
+    def timelapse_images(self, N):
+        """Write the frame nearest each time step to disk, picked from the frame times as they arrive"""
+        recorders = self.make_recorders(self.timestamp(self.now), N)
+        if not recorders:
+            self.statusSig.emit("Choose a file type to save the time-lapse to")
+            return
+        pool = writer_pool(recorders)
+        pool.start()
+        tl = timelapse(self.timestep.value(), N, target=pool.append)
+        self.register_func(tl.append)
+        while not tl.wait(0.5):
+            self.statusSig.emit(tl.status() + ", " + pool.status(N))
+        self.images = None
+        self.wait_for_pool(pool, N)
+        print(tl.status())
+
+    def timestamp(self, now):
+        return now.isoformat(timespec='seconds')[:19].replace(":","-")
+
+    def make_recorders(self, timestamp, N=None, timeout=1.):
+        """A recorder for each of the chosen file types"""
+        fname = self.fname + timestamp
+        recorders = []
+        if self.savefitscheck.isChecked():
+            recorders.append(fits_recorder(f"{fname}.fits", N, exposure=self.exptime.value(), timeout=timeout))
+        if self.savehdf5check.isChecked():
+            recorders.append(hdf5_recorder(f"{fname}.hdf5", N, exposure=self.exptime.value(), timeout=timeout,
+                compression=self.compressioncombo.currentText(), chunks=self.chunkframes.value()))
+        if self.saverawcheck.isChecked():
+            recorders.append(raw_recorder(f"{fname}.raw", N, exposure=self.exptime.value(), timeout=timeout))
+        return recorders
+
+    def wait_for_pool(self, pool, N=None):
+        """Report the progress of a writer_pool until it's finished"""
+        while not pool.wait(0.5):
+            self.statusSig.emit(pool.status(N))
+        status = f"Saved {pool.written} images"
+        if pool.dropped:
+            status += f", dropped {pool.dropped}"
+        if pool.errors():
+            status += f", {len(pool.errors())} files failed"
+        self.statusSig.emit(status)
+
+    def stream_images(self, N):
+        """Write N consecutive images to disk as they arrive instead of collecting them first"""
+        recorders = self.make_recorders(self.timestamp(self.now), N)
+        if not recorders:
+            self.statusSig.emit("Choose a file type to stream to disk")
+            return
+        pool = writer_pool(recorders)
+        pool.start()
+        self.register_func(pool.append)
+        self.images = None
+        self.wait_for_pool(pool, N)
+
     def save_current_images(self, event=None, now=None):
         if now is None:
             now = get_now()
         # timestamp = f"{now.year:0>4}-{now.month:0>2}-{now.day:0>2}T{now.hour:0>2}{now.minute:0>2}{now.second:0>2}"
-        timestamp = now.isoformat(timespec='seconds')[:19].replace(":","-")
+        timestamp = self.timestamp(now)
+        if self.images is not None and self.images.ndim == 3:
+            # each file type written by its own thread
+            pool = writer_pool(self.make_recorders(timestamp, len(self.images), timeout=None))
+            pool.start()
+            pool.write_images(self.images)
+            self.wait_for_pool(pool, len(self.images))
+            return
         if self.savefitscheck.isChecked():
             self.save_many_fits(timestamp)
         if self.savehdf5check.isChecked():
             self.save_many_hdf5(timestamp)
+        if self.saverawcheck.isChecked():
+            self.save_many_raw(timestamp)
 
     def filedialogbutton_callback(self,event):
-        # fname = QtG.QFileDialog.getOpenFileName(self, 'Open file', 'darc_images',"Image files (*.FITS *.hdf5)")
+        # fname = QtG.QFileDialog.getOpenFileName(self, 'Open file', 'darc_images',"Image files (*.FITS *.fits *.hdf5 *.raw)")
         self.dir_path = QtW.QFileDialog.getExistingDirectory(self, 'Select Dave Directory',str(Path.home()))
         self.update_filenamepreview()
 
@@ -323,14 +515,23 @@ class CamSaver(QtW.QWidget):
             file = h5py.File(f"{fname}.hdf5", "w")
 
             # Create a dataset in the file
+            images = numpy.asarray(self.images)
+            chunks = chunk_shape(min(self.chunkframes.value(), len(images)), images.shape[1:]) if images.ndim == 3 else None
             dataset = file.create_dataset(
-                "images", numpy.shape(self.images), dtype="uint16", data=self.images
+                "images", images.shape, dtype=images.dtype, data=images, chunks=chunks,
+                **hdf5_filter_args(self.compressioncombo.currentText())
             )
             meta_set = file.create_dataset(
                 "meta", numpy.shape(labels), dtype="f", data=labels
             )
             file.close()
 
+    def save_many_raw(self, timestamp=""):
+        if self.images is not None:
+            images = self.images if self.images.ndim == 3 else self.images[None]
+            fname = self.fname + timestamp
+            save_images(raw_recorder(f"{fname}.raw", exposure=self.exptime.value()), images)
+
     def save_many_fits(self,timestamp=""):
         # for i,im in enumerate(images):
         #     hdu = fits.PrimaryHDU(im)
@@ -338,7 +539,11 @@ class CamSaver(QtW.QWidget):
         if self.images is not None:
 
             fname = self.fname + timestamp
-            fits.writeto(f'{fname}.fits', self.images)
+            if self.images.ndim == 3:
+                # written a frame at a time, with the frame times in an extension
+                save_images(fits_recorder(f"{fname}.fits", exposure=self.exptime.value()), self.images)
+            else:
+                fits.writeto(f'{fname}.fits', self.images)
 
             # this old style was used before.....
             # hdul = fits.HDUList()
@@ -358,24 +563,19 @@ class CamSaver(QtW.QWidget):
             # data = numpy.array(data)
 
     def opendisplay(self):
-        print(self.images.shape)
-        print(self.images.dtype)
         if self.images is not None:
             self.imdisplay.update(self.images)
             self.imdisplay.show()
 
     def openfile(self):
-        fname = QtW.QFileDialog.getOpenFileName(self, 'Open file', str(self.dir_path), "Image files (*.FITS *.hdf5)",options=QtW.QFileDialog.DontUseNativeDialog)
+        fname = QtW.QFileDialog.getOpenFileName(self, 'Open file', str(self.dir_path), "Image files (*.FITS *.fits *.hdf5 *.raw)",options=QtW.QFileDialog.DontUseNativeDialog)
         if fname == ('',''):
             return
-        fext = fname[0].split(".")[-1]
-        if fext in ("FITS","fits"):
-            data = fits.getdata(fname[0])
-            images = data
-        elif fext == "hdf5":
-            file = h5py.File(fname[0], "r")
-            images = file['images'][:]
-            file.close()
+        try:
+            images = open_frames(fname[0])
+        except (ValueError, OSError) as e:
+            print(e)
+            return
         self.imdisplay.update(images)
         self.imdisplay.show()
 
@@ -401,7 +601,7 @@ if __name__ == "__main__":
     read_zmq.start()
 
     app = QtW.QApplication(sys.argv)
-    this = CamSaver(read_zmq.oneshot,read_zmq.multishot)
+    this = CamSaver(read_zmq.oneshot,read_zmq.multishot_into,register_func=read_zmq.register)
 
     this.show()
     ret = app.exec()
@@ -0,0 +1,148 @@
+import threading
+import numpy
+from pydcam.utils.numpy_circ_buf import META_DTYPE, with_meta
+from pydcam.utils.cb_thread import CallbackFilter, CallbackWorker, CallbackQueue
+from pydcam.utils.recorder import RecorderDone
+from pydcam.utils.timelapse import timelapse
+
+"""
+
+Checks the callback filters, the worker drop policies and the time-lapse frame choice
+with made up frames and times, python -m pydcam.tests.callback_test
+
+"""
+
+def frame(seq, t=0.):
+    arr = numpy.full((8,8), seq, dtype=numpy.uint16)
+    arr[2,3] = 1000 + seq
+    return with_meta(arr, numpy.array((seq, seq, t, t), dtype=META_DTYPE)[()])
+
+class fake_clock():
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+def test_every_nth():
+    got = []
+    filt = CallbackFilter(got.append, every_nth=3)
+    for i in range(10):
+        filt(frame(i))
+    assert [int(f.meta['seq']) for f in got] == [2, 5, 8]
+
+def test_max_rate():
+    got = []
+    clock = fake_clock()
+    filt = CallbackFilter(got.append, max_rate=10, clock=clock)
+    # frames every 30 ms, at most one per 100 ms gets through
+    for i in range(20):
+        clock.now = i*0.03
+        filt(frame(i))
+    assert [int(f.meta['seq']) for f in got] == [0, 4, 8, 12, 16]
+
+def test_roi_and_combined():
+    got = []
+    clock = fake_clock()
+    filt = CallbackFilter(got.append, max_rate=10, every_nth=2, roi=numpy.s_[2:4, 3:6], clock=clock)
+    for i in range(12):
+        clock.now = i*0.04
+        filt(frame(i))
+    # every 2nd frame (1, 3, 5...) then at most one per 100 ms of those
+    assert [int(f[0,0]) for f in got] == [1001, 1005, 1009]
+    assert got[0].shape == (2,3)
+
+def test_worker_drop_policies():
+    owner = {}
+    # not started, so nothing is taken off the queues
+    oldest = CallbackWorker(owner, 0, None, maxsize=2, policy="oldest")
+    newest = CallbackWorker(owner, 1, None, maxsize=2, policy="newest")
+    for i in range(6):
+        oldest(i)
+        newest(i)
+    assert list(oldest.queue.queue) == [4, 5] and oldest.dropped == 4
+    assert list(newest.queue.queue) == [0, 1] and newest.dropped == 4
+
+    got = []
+    done = threading.Event()
+    def slow(i):
+        got.append(i)
+        if i == 19:
+            done.set()
+    block = CallbackWorker(owner, 2, slow, maxsize=2, policy="block")
+    block.start()
+    for i in range(20):
+        block(i)
+    assert done.wait(5)
+    block.stop()
+    assert got == list(range(20)) and block.dropped == 0
+
+def test_worker_removes_failing_callback():
+    callbacks = CallbackQueue(threaded=True)
+    failed = threading.Event()
+    def bad(data):
+        failed.set()
+        raise RecorderDone()
+    callbacks.add(1, bad)
+    callbacks.add(2, lambda data: None, every_nth=2)
+    callbacks(frame(0))
+    assert failed.wait(5)
+    for i in range(50):
+        if 1 not in callbacks:
+            break
+        threading.Event().wait(0.01)
+    assert 1 not in callbacks and 2 in callbacks
+    callbacks.stop()
+
+def feed(tl, times):
+    for i, t in enumerate(times):
+        try:
+            tl.append(frame(i, t))
+        except RecorderDone:
+            break
+
+def test_timelapse_nearest():
+    got = []
+    tl = timelapse(1., target=got.append, clock="timestamp")
+    # frames every 0.3 s, ticks every second from the first frame
+    feed(tl, [round(i*0.3, 6) for i in range(12)])
+    assert [float(f.meta['timestamp']) for f in got] == [0., 0.9, 2.1, 3.]
+    mean, std, worst = tl.jitter()
+    assert tl.count == 4 and tl.missed == 0
+    assert abs(mean - 0.) < 1e-9 and abs(worst - 0.1) < 1e-9
+    assert abs(std - numpy.sqrt(0.005)) < 1e-9
+
+def test_timelapse_stall_and_nframes():
+    got = []
+    tl = timelapse(1., nframes=4, target=got.append, clock="timestamp")
+    # a stall from 1.1 s to 4.05 s, ticks 2 and 3 have no frame near them
+    times = [0., 0.5, 1.0, 1.1, 4.05, 4.5, 5.0, 5.5, 6.0, 6.5]
+    feed(tl, times)
+    assert [float(f.meta['timestamp']) for f in got] == [0., 1.0, 4.05, 5.0]
+    assert tl.missed == 2
+    assert tl.wait(0)
+    try:
+        tl.append(frame(99, 7.))
+    except RecorderDone:
+        pass
+    else:
+        assert False, "append after nframes didn't raise"
+
+def test_timelapse_kept_frame_is_a_copy():
+    got = []
+    tl = timelapse(1., target=got.append, clock="timestamp")
+    buf = frame(0, 0.)
+    tl.append(buf)
+    # 0.95 is kept as the candidate for tick 1, then its buffer is reused for the next frame
+    buf = frame(1, 0.95)
+    tl.append(buf)
+    buf[...] = 7
+    buf.meta = numpy.array((2, 2, 1.2, 1.2), dtype=META_DTYPE)[()]
+    tl.append(buf)
+    assert float(got[1].meta['timestamp']) == 0.95 and int(got[1][0,0]) == 1
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "ok")
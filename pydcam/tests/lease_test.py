@@ -0,0 +1,53 @@
+import threading
+import time
+import numpy
+from pydcam.utils.numpy_circ_buf import thread_buf
+
+"""
+
+Holds each leased frame for a while as the producer laps the ring and checks the view
+was never written to, python -m pydcam.tests.lease_test [seconds] [hold ms]
+
+"""
+
+def test_lease_not_overwritten(seconds=1., hold=0.002):
+    buf = thread_buf((64,64), 4, "uint16")
+    go = True
+    def produce():
+        frame = numpy.empty((64,64), dtype=numpy.uint16)
+        cnt = 0
+        while go:
+            # every pixel is the seq so a torn or replaced frame shows up
+            frame[:] = cnt%65536
+            buf.copy_numpy(frame)
+            cnt += 1
+            time.sleep(0.0001)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    reader = buf.add_reader("lease", "skip")
+    checked = 0
+    bad = 0
+    end = time.perf_counter() + seconds
+    try:
+        while time.perf_counter() < end:
+            lease = reader.lease(block=1)
+            if lease is None:
+                continue
+            with lease as data:
+                time.sleep(hold)
+                if numpy.any(data != lease.seq%65536):
+                    bad += 1
+                checked += 1
+    finally:
+        go = False
+        producer.join()
+    print(f"checked {checked} frames, {bad} overwritten, {buf.counters.lease_swaps} slots swapped")
+    assert checked > 0
+    assert bad == 0
+    assert buf.counters.lease_swaps > 0
+
+if __name__ == "__main__":
+    import sys
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.
+    hold = float(sys.argv[2])/1000 if len(sys.argv) > 2 else 0.002
+    test_lease_not_overwritten(seconds, hold)
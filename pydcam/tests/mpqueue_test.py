@@ -1,7 +1,7 @@
 
 """
 
-Doesn't really work...
+Run with 0 to publish and 1 to read, in separate terminals
 
 """
 
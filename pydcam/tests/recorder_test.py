@@ -0,0 +1,31 @@
+from pydcam.dcam_reader import DCamSim
+from pydcam.utils.recorder import hdf5_recorder
+import sys
+
+"""
+
+Records N frames from the simulator to a file, python -m pydcam.tests.recorder_test fname [N]
+
+"""
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        fname = sys.argv[1]
+    else:
+        print("Need a file name")
+        sys.exit()
+    N = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    camreader = DCamSim()
+    camreader.open_camera()
+    camreader.set_exposure(0.01)
+
+    rec = hdf5_recorder(fname, N, exposure=0.01)
+    rec.start()
+    camreader.register_callback(rec.append)
+    rec.wait()
+    print(f"Wrote {rec.written} frames at {rec.rate():.1f} fps, dropped {rec.dropped}")
+
+    print("closing")
+    camreader.quit()
@@ -0,0 +1,79 @@
+"""
+Compare the per-frame cost of thread_buf and seq_buf.
+
+A producer thread writes frames as fast as it can (or at a target rate)
+while a reader thread takes them with get_latest(block=1, copy=1) like
+pub_thread does. Small subarrays are where the per-frame overhead matters.
+
+python -m pydcam.tests.ring_bench [seconds] [height] [width]
+"""
+
+import sys
+import time
+import ctypes
+import threading
+import numpy
+from pydcam.utils.numpy_circ_buf import thread_buf, seq_buf
+
+class producer(threading.Thread):
+    def __init__(self, buf, frames, rate=0):
+        super().__init__()
+        self.buf = buf
+        self.frames = frames
+        self.period = 1/rate if rate else 0
+        self.go = True
+        self.count = 0
+        self.busy = 0.
+
+    def run(self):
+        n = len(self.frames)
+        addresses = [f.ctypes.data_as(ctypes.c_void_p) for f in self.frames]
+        size = self.frames[0].nbytes
+        next_time = time.perf_counter()
+        while self.go:
+            start = time.perf_counter()
+            self.buf.copy_from_address(addresses[self.count%n], size, self.count, start)
+            self.busy += time.perf_counter() - start
+            self.count += 1
+            if self.period:
+                next_time += self.period
+                while time.perf_counter() < next_time:
+                    pass
+
+class consumer(threading.Thread):
+    def __init__(self, buf):
+        super().__init__()
+        self.buf = buf
+        self.go = True
+        self.count = 0
+
+    def run(self):
+        while self.go:
+            if self.buf.get_latest(block=1, copy=1) is not None:
+                self.count += 1
+
+def bench(buf_type, shape, seconds, rate=0):
+    frames = numpy.random.randint(0, 4096, (16, *shape)).astype(numpy.uint16)
+    buf = buf_type(shape, 10, "uint16", timeout=0.1)
+    prod = producer(buf, frames, rate)
+    cons = consumer(buf)
+    cons.start()
+    prod.start()
+    time.sleep(seconds)
+    prod.go = False
+    prod.join()
+    cons.go = False
+    buf.cancel_wait()
+    cons.join()
+    return prod.count, 1e6*prod.busy/prod.count, cons.count, buf.counters.overruns
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.
+    shape = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (64, 64)
+
+    for rate in (0, 10000):
+        print(f"{shape} frames, target rate {rate or 'max'}:")
+        for buf_type in (thread_buf, seq_buf):
+            written, per_frame, read, overruns = bench(buf_type, shape, seconds, rate)
+            print(f"  {buf_type.__name__:>10}: wrote {written/seconds:9.0f} fps, "
+                f"{per_frame:6.2f} us per write, read {read/seconds:9.0f} fps, overruns {overruns}")
@@ -0,0 +1,54 @@
+"""
+Load test the pipeline with the simulated camera.
+
+DCamSim runs at a target rate and a callback on the publisher keeps the metadata of
+every frame it's given. Prints the rate the camera held, the spread of the frame
+intervals, the frames lost to framestamp gaps and what the publisher got, so it can
+run on CI to catch the pipeline slowing down. With faults the simulator also drops
+1 in 1000 frames and stalls now and then.
+
+python -m pydcam.tests.sim_bench [fps] [seconds] [height] [width] [faults]
+"""
+
+import sys
+import time
+import numpy
+from pydcam.dcam_reader import DCamSim
+
+class meta_log():
+    def __init__(self):
+        self.meta = []
+
+    def append(self, data):
+        self.meta.append(data.meta.copy())
+
+def bench(fps, seconds, shape, faults=False, **sim_options):
+    if faults:
+        sim_options = dict(dict(drop_prob=0.001, jitter=fps and 0.1/fps, stall_prob=0.0005, stall_time=0.01), **sim_options)
+    camreader = DCamSim(fps=fps, shape=shape, lockfree=True, **sim_options)
+    log = meta_log()
+    camreader.register_callback(log.append)
+    camreader.open_camera()
+    time.sleep(seconds)
+    camreader.quit()
+    counters = camreader.buffers.counters
+    meta = numpy.array(log.meta)
+    return counters, meta
+
+if __name__ == "__main__":
+    fps = float(sys.argv[1]) if len(sys.argv) > 1 else 1000.
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.
+    shape = (int(sys.argv[3]), int(sys.argv[4])) if len(sys.argv) > 4 else (128, 128)
+    faults = len(sys.argv) > 5 and sys.argv[5] == "faults"
+
+    counters, meta = bench(fps, seconds, shape, faults)
+    print(f"{shape} frames at {fps:.0f} fps for {seconds}s" + (" with faults" if faults else ""))
+    stamps = meta["framestamp"]
+    span = meta["timestamp"][-1] - meta["timestamp"][0] if len(meta) > 1 else 0.
+    print(f"  camera: {counters.captured} frames, {(stamps[-1]-stamps[0]+1)/span if span else 0.:.0f} fps held, "
+        f"{counters.frames_lost} lost in {counters.framestamp_gaps} gaps")
+    intervals = numpy.diff(meta["recvtime"])*1e3
+    if len(intervals):
+        print(f"  interval: {intervals.mean():.3f}+-{intervals.std():.3f} ms, "
+            f"99% {numpy.percentile(intervals, 99):.3f} ms, max {intervals.max():.3f} ms")
+    print(f"  publisher: {len(meta)} frames ({len(meta)/max(counters.captured,1):.1%}), overruns {counters.overruns}")
@@ -0,0 +1,117 @@
+import os
+import struct
+import numpy
+from pydcam.utils.numpy_circ_buf import META_DTYPE, with_meta
+from pydcam.utils.frame_header import HEADER_SIZE, HEADER_DTYPE, pack_header, unpack_header, array_from_header
+from pydcam.utils.frame_codec import available_codecs, codec_id, encode, decode
+from pydcam.utils.shmem import shmem_publisher, shmem_reader
+
+"""
+
+Checks the frame header, codecs and the shared memory ring in one process,
+python -m pydcam.tests.transport_test
+
+"""
+
+DTYPES = ("uint8", "uint16", "int16", "int32", "float32", "float64")
+
+def frame(dtype, shape=(48,64), seq=0):
+    arr = (numpy.arange(numpy.prod(shape))*7%251).reshape(shape).astype(dtype)
+    meta = numpy.array((seq, 1000+seq, 0.5*seq, 12.25+seq), dtype=META_DTYPE)[()]
+    return with_meta(arr, meta)
+
+# the byte layout of version 1 of the header, other processes and machines depend on it
+HEADER_OFFSETS = {'magic':0, 'version':4, 'codec':6, 'ndim':8, 'flags':10, 'typestr':12, 'shape':16, 'strides':48,
+    'nbytes':80, 'payload':88, 'seq':96, 'framestamp':104, 'timestamp':112, 'recvtime':120, 'sendtime':128}
+
+def test_header_layout():
+    assert HEADER_SIZE == 136
+    assert {n:HEADER_DTYPE.fields[n][1] for n in HEADER_DTYPE.names} == HEADER_OFFSETS
+    raw = pack_header(frame("uint16", (48,64), seq=42))
+    assert raw[:4] == b"PDCF" and raw[12:16] == b"<u2\0"
+    assert struct.unpack_from("<HHHH", raw, 4) == (1, 0, 2, 0)
+    assert struct.unpack_from("<4q", raw, 16) == (48, 64, 0, 0)
+    assert struct.unpack_from("<4q", raw, 48) == (128, 2, 0, 0)
+    assert struct.unpack_from("<qqqqdd", raw, 80) == (6144, 6144, 42, 1042, 21., 54.25)
+
+def test_header_round_trip():
+    for dtype in DTYPES:
+        for shape in ((48,64), (3,48,64), (100,)):
+            arr = frame(dtype, shape, seq=42)
+            raw = pack_header(arr)
+            assert len(raw) == HEADER_SIZE
+            hdr = unpack_header(raw)
+            assert hdr.typestr.decode() == numpy.dtype(dtype).str
+            assert hdr.shape == shape and hdr.nbytes == arr.nbytes == hdr.payload
+            assert (hdr.seq, hdr.framestamp, hdr.timestamp, hdr.recvtime) == (42, 1042, 21., 54.25)
+            out = array_from_header(hdr, arr.tobytes())
+            assert out.dtype == arr.dtype and numpy.array_equal(out, arr)
+            assert out.meta == arr.meta
+
+    # packed into a buffer at an offset, a frame without meta takes seq from the argument
+    buf = bytearray(HEADER_SIZE+16)
+    arr = numpy.ones((4,5), dtype=numpy.uint16)
+    pack_header(arr, seq=7, codec=5, payload=11, buffer=buf, offset=16)
+    hdr = unpack_header(buf, 16)
+    assert (hdr.seq, hdr.framestamp, hdr.codec, hdr.payload, hdr.nbytes) == (7, -1, 5, 11, 40)
+
+    # a transposed view is described C-contiguous, as the payload is sent
+    arr = frame("uint16").T
+    hdr = unpack_header(pack_header(arr))
+    assert numpy.array_equal(array_from_header(hdr, numpy.ascontiguousarray(arr).tobytes()), arr)
+
+    for bad in (b"XXXX"+pack_header(arr)[4:], pack_header(arr)[:4]+b"\xff\xff"+pack_header(arr)[6:]):
+        try:
+            unpack_header(bad)
+        except ValueError:
+            pass
+        else:
+            assert False, "bad header accepted"
+
+def test_codecs():
+    for name in available_codecs():
+        codec = codec_id(name)
+        for dtype in DTYPES:
+            arr = frame(dtype)
+            payload = encode(arr, codec)
+            out = numpy.frombuffer(decode(payload, codec, arr.nbytes, arr.dtype), dtype=arr.dtype).reshape(arr.shape)
+            assert numpy.array_equal(out, arr), (name, dtype)
+
+def test_shmem_policies():
+    name = f"pydcam_test_{os.getpid()}"
+    pub = shmem_publisher(64*64*2, name=name, nslots=4)
+    readers = []
+    try:
+        drop = shmem_reader(name, policy="drop")
+        skip = shmem_reader(name, policy="skip")
+        lapped = shmem_reader(name, policy="drop")
+        readers = [drop, skip, lapped]
+        for seq in range(3):
+            pub.publish(frame("uint16", (64,64), seq))
+        # drop reads every frame in order, skip only the newest
+        for seq in range(3):
+            arr = drop.get_data()
+            assert arr.meta['seq'] == seq and numpy.array_equal(arr, frame("uint16", (64,64), seq))
+        assert skip.get_data().meta['seq'] == 2
+        for seq in range(3, 13):
+            pub.publish(frame("uint16", (64,64), seq))
+        assert skip.get_data().meta['seq'] == 12
+        # 13 frames in a 4 slot ring, the oldest slot may be being written so the
+        # first readable frame is 10 and frames 0-9 are counted as dropped
+        arr = lapped.get_data()
+        assert arr.meta['seq'] == 10 and lapped.overruns == 10
+        assert [lapped.get_data().meta['seq'] for i in range(2)] == [11, 12]
+        arr = drop.get_data()
+        assert arr.meta['seq'] == 10 and drop.overruns == 7
+    finally:
+        for reader in readers:
+            reader.stop()
+        pub.close()
+
+if __name__ == "__main__":
+    test_header_layout()
+    test_header_round_trip()
+    test_codecs()
+    print("codecs checked:", ", ".join(available_codecs()))
+    test_shmem_policies()
+    print("All good")
@@ -1,25 +1,159 @@
-
-
 import threading
+import queue
+import os
 import time
+import numpy
+
+from pydcam.utils.numpy_circ_buf import META_DTYPE, with_meta
+
+# what a subscriber's queue does when it's full
+# oldest: drop the oldest queued frame, newest: drop the new frame, block: wait for room
+DROP_POLICIES = ("oldest", "newest", "block")
+
+class CallbackWorker(threading.Thread):
+    """Calls one subscriber from its own thread with a bounded queue of frames.
+    If func raises the worker removes itself from its CallbackQueue."""
+    def __init__(self, owner, fid, func, maxsize=4, policy="oldest"):
+        super().__init__(daemon=True)
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {policy}, use one of {DROP_POLICIES}")
+        self.owner = owner
+        self.fid = fid
+        self.func = func
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.active = True
+        self.dropped = 0
+
+    def __call__(self, cb_data):
+        """Queue cb_data for func, called by the dispatching thread"""
+        if not self.active:
+            return
+        try:
+            self.queue.put_nowait(cb_data)
+            return
+        except queue.Full:
+            pass
+        if self.policy == "oldest":
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.dropped += 1
+            self.queue.put_nowait(cb_data)
+        elif self.policy == "newest":
+            self.dropped += 1
+        else:
+            while self.active:
+                try:
+                    self.queue.put(cb_data, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+    def run(self):
+        while self.active:
+            cb_data = self.queue.get()
+            if cb_data is None or not self.active:
+                break
+            try:
+                self.func(cb_data)
+            except:
+                self.active = False
+                self.owner.pop(self.fid)
+
+    def stop(self):
+        self.active = False
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            # run() checks active after the get
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(None)
+            except (queue.Empty, queue.Full):
+                pass
+
+class CallbackFilter():
+    """Passes only some frames on to target, applied before they are queued for a worker.
+        max_rate: at most this many frames per second
+        every_nth: only every nth frame
+        roi: index applied to each frame, e.g. numpy.s_[100:200, 300:400]
+    clock gives the time in seconds for max_rate"""
+    def __init__(self, target, max_rate=None, every_nth=None, roi=None, clock=time.perf_counter):
+        self.target = target
+        self.clock = clock
+        self.interval = 1/max_rate if max_rate else 0
+        self.every_nth = every_nth
+        self.roi = roi
+        self.last = None
+        self.count = 0
+
+    def __call__(self, cb_data):
+        if self.every_nth:
+            self.count += 1
+            if self.count < self.every_nth:
+                return
+            self.count = 0
+        if self.interval:
+            now = self.clock()
+            if self.last is not None and now - self.last < self.interval:
+                return
+            self.last = now
+        if self.roi is not None:
+            cb_data = cb_data[self.roi]
+        self.target(cb_data)
+
+def _worker(cb):
+    if isinstance(cb, CallbackFilter):
+        cb = cb.target
+    if isinstance(cb, CallbackWorker):
+        return cb
+    return None
 
 class CallbackQueue(dict):
-    def __init__(self,*args,**kwargs):
+    """The registered callbacks, called with each new frame.
+    If threaded each callback gets its own CallbackWorker so a slow one doesn't hold up the others,
+    maxsize and policy are the defaults for the workers' queues."""
+    def __init__(self,*args,threaded=False,maxsize=4,policy="oldest",**kwargs):
         super().__init__(*args,**kwargs)
         self.lock = threading.Lock()
+        self.threaded = threaded
+        self.maxsize = maxsize
+        self.policy = policy
 
     def pop(self, key):
         """Like dict.pop but always returns None if key doesn't exist"""
         with self.lock:
-            return super().pop(key, None)
+            cb = super().pop(key, None)
+        worker = _worker(cb)
+        if worker is not None:
+            worker.stop()
+        return cb
     
     def __setitem__(self, __k, __v):
         """Locking setitem"""
         with self.lock:
             super().__setitem__(__k, __v)
 
+    def add(self, fid, func, maxsize=None, policy=None, **filters):
+        """Register func under fid, wrapping it in a worker if threaded and
+        in a CallbackFilter if any of max_rate, every_nth or roi are given"""
+        if self.threaded:
+            worker = CallbackWorker(self, fid, func, maxsize or self.maxsize, policy or self.policy)
+            worker.start()
+            func = worker
+        if any(v is not None for v in filters.values()):
+            func = CallbackFilter(func, **filters)
+        self.pop(fid)
+        self[fid] = func
+
     def __call__(self, cb_data):
         """iterate through dict with lock"""
+        if self.threaded and isinstance(cb_data, numpy.ndarray) and not cb_data.flags.writeable:
+            # a leased view is released once we return, the workers need their own copy
+            cb_data = cb_data.copy()
+            cb_data.flags.writeable = False
         poplater = []
         with self.lock:
             for fid,cb in self.items():
@@ -30,14 +164,28 @@ class CallbackQueue(dict):
         for key in poplater:
             super().pop(key, None)
 
+    def dropped(self):
+        """Frames dropped by each worker's queue"""
+        with self.lock:
+            return {fid:_worker(cb).dropped for fid,cb in self.items() if _worker(cb) is not None}
+
+    def stop(self):
+        with self.lock:
+            workers = [_worker(cb) for cb in self.values()]
+        for worker in filter(None, workers):
+            worker.stop()
+
 class CallbackThread(threading.Thread):
-    def __init__(self, startpaused=False, ratelimit=0):
+    """Gets data with get_data() and passes it to the registered callbacks.
+    With threaded=True each callback runs in its own thread with a queue of queue_size
+    frames and the drop_policy from DROP_POLICIES."""
+    def __init__(self, startpaused=False, ratelimit=0, threaded=False, queue_size=4, drop_policy="oldest"):
         super().__init__()
 
         self.ratelimit = ratelimit
         self.now = time.perf_counter()
 
-        self.callbacks = CallbackQueue()
+        self.callbacks = CallbackQueue(threaded=threaded, maxsize=queue_size, policy=drop_policy)
         self._go = True
         self._pause = startpaused
 
@@ -53,6 +201,10 @@ class CallbackThread(threading.Thread):
         """Needs reimplementing in subclass"""
         pass
 
+    def release_data(self, cb_data):
+        """Called once the callbacks are done with cb_data, reimplement if needed"""
+        pass
+
     def run(self):
         while(self._go):
             if self._pause:
@@ -67,8 +219,10 @@ class CallbackThread(threading.Thread):
                     if time.perf_counter()-self.now > self.ratelimit:
                         self.now = time.perf_counter()
                     else:
+                        self.release_data(cb_data)
                         continue
                 self.callbacks(cb_data)
+                self.release_data(cb_data)
 
     def pause(self):
         self.wait_while_paused.clear()
@@ -81,10 +235,14 @@ class CallbackThread(threading.Thread):
     def stop(self):
         self._go = False
         self.unpause()
+        self.callbacks.stop()
 
-    def register(self, func):
+    def register(self, func, max_rate=None, every_nth=None, roi=None, queue_size=None, drop_policy=None):
+        """Call func with new data, returns an id for deregister.
+        max_rate (Hz), every_nth and roi only apply to this callback, see CallbackFilter.
+        queue_size and drop_policy override the defaults when threaded"""
         fid = str(id(func))
-        self.callbacks[fid] = func
+        self.callbacks.add(fid, func, queue_size, drop_policy, max_rate=max_rate, every_nth=every_nth, roi=roi)
         return fid
 
     def deregister(self, fid):
@@ -93,7 +251,8 @@ class CallbackThread(threading.Thread):
     def oneshot(self):
         ready = threading.Event()
         def func(data):
-            self.oneshot_data = data
+            # read-only data may be a leased view, keep a copy
+            self.oneshot_data = data if data.flags.writeable else data.copy()
             ready.set()
         self.oneshot_callback(func)
         ready.wait()
@@ -103,13 +262,13 @@ class CallbackThread(threading.Thread):
         def wrapper(data):
             func(data)
             raise Exception()
-        self.register(wrapper)
+        self.register(wrapper, queue_size=1, drop_policy="newest")
 
     def multishot(self, n):
         ready = threading.Event()
         self.multishot_return = []
         def func(data, done):
-            self.multishot_return.append(data)
+            self.multishot_return.append(data if data.flags.writeable else data.copy())
             if done:
                 ready.set()
         self.multishot_callback(func, n)
@@ -124,7 +283,55 @@ class CallbackThread(threading.Thread):
             if test:
                 raise Exception()
             cnt[0] += 1
-        self.register(wrapper)
+        # when threaded queue every frame so they're consecutive
+        self.register(wrapper, queue_size=n, drop_policy="block")
+
+    def multishot_into(self, n, out=None):
+        """Like multishot but each frame is copied straight into one (n, ...) array, returned as
+        a frame_array with a META_DTYPE record per frame in .meta.
+        out is a preallocated array, a path for a .npy memory map, or None to allocate one"""
+        ready = threading.Event()
+        meta = numpy.zeros(n, dtype=META_DTYPE)
+        ret = [out]
+        err = [None]
+        cnt = [0]
+        def func(data, done):
+            i = cnt[0]
+            try:
+                if i == 0:
+                    ret[0] = self._multishot_out(ret[0], n, data)
+                ret[0][i] = data
+            except Exception as e:
+                err[0] = e
+                ready.set()
+                raise
+            frame_meta = getattr(data, 'meta', None)
+            if frame_meta is not None and frame_meta.ndim == 0:
+                meta[i] = frame_meta
+            else:
+                meta[i] = (i, -1, 0., time.perf_counter())
+            cnt[0] += 1
+            if done:
+                ready.set()
+        self.multishot_callback(func, n)
+        ready.wait()
+        if err[0] is not None:
+            raise err[0]
+        out = ret[0]
+        if isinstance(out, numpy.memmap):
+            out.flush()
+        return with_meta(out, meta)
+
+    @staticmethod
+    def _multishot_out(out, n, data):
+        shape = (n, *data.shape)
+        if out is None:
+            return numpy.empty(shape, dtype=data.dtype)
+        if isinstance(out, (str, os.PathLike)):
+            return numpy.lib.format.open_memmap(out, mode="w+", dtype=data.dtype, shape=shape)
+        if out.shape[0] < n or out.shape[1:] != data.shape:
+            raise ValueError(f"out has shape {out.shape}, need {shape}")
+        return out
 
     def __enter__(self):
         self.start()
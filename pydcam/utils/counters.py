@@ -0,0 +1,63 @@
+
+import time
+
+class frame_counters():
+    """Counters for the acquisition path.
+    Updated with plain attribute increments from the camera and reader threads
+    so they cost next to nothing, use snapshot() to read them."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.captured = 0
+        self.framestamp_gaps = 0
+        self.frames_lost = 0
+        self.wait_timeouts = 0
+        self.wait_errors = 0
+        self.copy_failures = 0
+        # slots the producer gave new memory because the frame was still leased
+        self.lease_swaps = 0
+        # frames lost to ring overruns, by consumer
+        self.overruns = {}
+        self.last_framestamp = -1
+
+    def restart(self):
+        """Call when capture restarts, the camera framestamp starts again"""
+        self.last_framestamp = -1
+
+    def check_framestamp(self, framestamp, n=1):
+        """Compare with the last framestamp, n is the number of frames expected since then"""
+        if framestamp < 0:
+            return
+        if self.last_framestamp >= 0:
+            gap = framestamp - self.last_framestamp - n
+            if gap > 0:
+                self.framestamp_gaps += 1
+                self.frames_lost += gap
+        self.last_framestamp = framestamp
+
+    def add_overrun(self, name, n):
+        self.overruns[name] = self.overruns.get(name, 0) + n
+
+    def snapshot(self):
+        return {
+            "elapsed": time.perf_counter() - self.start_time,
+            "captured": self.captured,
+            "framestamp_gaps": self.framestamp_gaps,
+            "frames_lost": self.frames_lost,
+            "wait_timeouts": self.wait_timeouts,
+            "wait_errors": self.wait_errors,
+            "copy_failures": self.copy_failures,
+            "lease_swaps": self.lease_swaps,
+            "overruns": dict(self.overruns),
+        }
+
+    def __str__(self):
+        snap = self.snapshot()
+        rate = snap["captured"]/snap["elapsed"] if snap["elapsed"] > 0 else 0
+        overruns = ", ".join(f"{k}: {v}" for k,v in snap["overruns"].items()) or "none"
+        return (f"captured {snap['captured']} frames in {snap['elapsed']:.1f}s ({rate:.1f} fps), "
+            f"lost {snap['frames_lost']} in {snap['framestamp_gaps']} framestamp gaps, "
+            f"{snap['wait_timeouts']} wait timeouts, {snap['wait_errors']} wait errors, "
+            f"{snap['copy_failures']} copy failures, {snap['lease_swaps']} lease swaps, overruns: {overruns}")
@@ -0,0 +1,124 @@
+import zlib
+import threading
+import numpy
+
+"""
+Lossless codecs for frame payloads, the codec number travels in the frame header.
+lz4, zstandard and bitshuffle are optional, use available_codecs() to see what can be used here.
+
+    none            raw bytes
+    lz4             lz4 block
+    zstd            zstandard level 1
+    shuffle-lz4     byte shuffle then lz4, groups the high bytes of 16 bit pixels together
+    bitshuffle-lz4  bitshuffle's own lz4 format
+    zlib            zlib level 1, always available
+    shuffle-zlib    byte shuffle then zlib
+"""
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+CODECS = {
+    "none":0,
+    "lz4":1,
+    "zstd":2,
+    "shuffle-lz4":3,
+    "bitshuffle-lz4":4,
+    "zlib":5,
+    "shuffle-zlib":6,
+}
+CODEC_NAMES = {v:k for k,v in CODECS.items()}
+
+_local = threading.local()
+
+def _zstd_compressor():
+    # zstandard contexts can't be shared between threads
+    if not hasattr(_local, "zc"):
+        _local.zc = zstandard.ZstdCompressor(level=1)
+    return _local.zc
+
+def _zstd_decompressor():
+    if not hasattr(_local, "zd"):
+        _local.zd = zstandard.ZstdDecompressor()
+    return _local.zd
+
+def shuffle(array):
+    """Byte shuffle, all the first bytes of each element, then all the second bytes..."""
+    return numpy.ascontiguousarray(array.reshape(-1).view(numpy.uint8).reshape(-1, array.itemsize).T)
+
+def unshuffle(buffer, dtype):
+    itemsize = numpy.dtype(dtype).itemsize
+    return numpy.ascontiguousarray(numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(itemsize, -1).T).view(dtype)
+
+def available_codecs():
+    ret = ["none", "zlib", "shuffle-zlib"]
+    if lz4_block is not None:
+        ret += ["lz4", "shuffle-lz4"]
+    if zstandard is not None:
+        ret += ["zstd"]
+    if bitshuffle is not None:
+        ret += ["bitshuffle-lz4"]
+    return ret
+
+def codec_id(codec):
+    """The codec number for a name or number, raises ValueError if unknown or not available"""
+    if isinstance(codec, str):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, use one of {list(CODECS)}")
+        name = codec
+    else:
+        if codec not in CODEC_NAMES:
+            raise ValueError(f"Unknown codec {codec}")
+        name = CODEC_NAMES[codec]
+    if name not in available_codecs():
+        raise ValueError(f"Codec {name} isn't available, install the module it needs")
+    return CODECS[name]
+
+def encode(array:numpy.ndarray, codec):
+    """Compress a C-contiguous array, returns a bytes-like payload"""
+    if codec == 0:
+        return array
+    if codec == 1:
+        return lz4_block.compress(array, store_size=False)
+    if codec == 2:
+        return _zstd_compressor().compress(array)
+    if codec == 3:
+        return lz4_block.compress(shuffle(array), store_size=False)
+    if codec == 4:
+        return bitshuffle.compress_lz4(array.reshape(-1))
+    if codec == 5:
+        return zlib.compress(array, 1)
+    if codec == 6:
+        return zlib.compress(shuffle(array), 1)
+    raise ValueError(f"Unknown codec {codec}")
+
+def decode(payload, codec, nbytes, dtype):
+    """Decompress a payload, returns a flat array of dtype (or payload itself for codec 0)"""
+    if codec == 0:
+        return payload
+    if codec == 1:
+        return numpy.frombuffer(lz4_block.decompress(payload, uncompressed_size=nbytes), dtype=dtype)
+    if codec == 2:
+        return numpy.frombuffer(_zstd_decompressor().decompress(payload, max_output_size=nbytes), dtype=dtype)
+    if codec == 3:
+        return unshuffle(lz4_block.decompress(payload, uncompressed_size=nbytes), dtype)
+    if codec == 4:
+        dtype = numpy.dtype(dtype)
+        return bitshuffle.decompress_lz4(numpy.frombuffer(payload, dtype=numpy.uint8), (nbytes//dtype.itemsize,), dtype)
+    if codec == 5:
+        return numpy.frombuffer(zlib.decompress(payload), dtype=dtype)
+    if codec == 6:
+        return unshuffle(zlib.decompress(payload), dtype)
+    raise ValueError(f"Unknown codec {codec}")
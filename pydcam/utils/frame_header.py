@@ -0,0 +1,101 @@
+import struct
+import time
+from collections import namedtuple
+import numpy
+
+from pydcam.utils.numpy_circ_buf import META_DTYPE, with_meta
+
+"""
+A fixed size binary header describing a frame, used by the shmem and zmq transports.
+
+The layout is a struct.Struct (HEADER), unpack_header returns it as a frame_header namedtuple.
+HEADER_DTYPE is the same layout as a numpy structured dtype, for viewing arrays of headers.
+
+    magic       b"PDCF"
+    version     HEADER_VERSION, bumped when the layout changes
+    codec       how the payload is encoded, 0 is raw bytes
+    ndim        number of dimensions, up to MAX_DIMS
+    flags       reserved
+    typestr     numpy dtype.str of the frame, e.g. b"<u2"
+    shape       shape, padded with 0
+    strides     strides of the raw frame, padded with 0
+    nbytes      size of the raw frame
+    payload     size of the payload as sent (differs from nbytes when compressed)
+    seq         frame sequence number
+    framestamp  camera framestamp, -1 if unknown
+    timestamp   camera timestamp in seconds
+    recvtime    time.perf_counter() when the frame arrived from the camera
+    sendtime    time.time() when the frame was published
+"""
+
+MAGIC = b"PDCF"
+HEADER_VERSION = 1
+MAX_DIMS = 4
+
+HEADER = struct.Struct("<4sHHHH4s4q4qqqqqddd")
+HEADER_DTYPE = numpy.dtype([('magic','S4'),('version','<u2'),('codec','<u2'),('ndim','<u2'),('flags','<u2'),
+    ('typestr','S4'),('shape','<i8',(MAX_DIMS,)),('strides','<i8',(MAX_DIMS,)),('nbytes','<i8'),('payload','<i8'),
+    ('seq','<i8'),('framestamp','<i8'),('timestamp','<f8'),('recvtime','<f8'),('sendtime','<f8')])
+HEADER_SIZE = HEADER.size
+
+assert HEADER_DTYPE.itemsize == HEADER_SIZE
+
+_pad = (0,)*MAX_DIMS
+
+def pack_header(array:numpy.ndarray, seq=0, codec=0, payload=None, buffer=None, offset=0):
+    """Pack the header for array, the frame metadata is taken from array.meta if present.
+    If buffer is given the header is written into it at offset, otherwise bytes are returned"""
+    ndim = array.ndim
+    if ndim > MAX_DIMS:
+        raise ValueError(f"Frames can have at most {MAX_DIMS} dimensions")
+    meta = getattr(array, 'meta', None)
+    if meta is not None and meta.ndim == 0:
+        seq, framestamp, timestamp, recvtime = meta['seq'], meta['framestamp'], meta['timestamp'], meta['recvtime']
+    else:
+        framestamp, timestamp, recvtime = -1, 0., 0.
+    nbytes = array.nbytes
+    if payload is None:
+        payload = nbytes
+    # the payload is always sent C-contiguous
+    strides = _c_strides(array)
+    args = (MAGIC, HEADER_VERSION, codec, ndim, 0, array.dtype.str.encode(),
+        *(array.shape+_pad)[:MAX_DIMS], *(strides+_pad)[:MAX_DIMS],
+        nbytes, payload, seq, framestamp, timestamp, recvtime, time.time())
+    if buffer is None:
+        return HEADER.pack(*args)
+    HEADER.pack_into(buffer, offset, *args)
+
+def _c_strides(array):
+    if array.flags.c_contiguous:
+        return array.strides
+    strides = []
+    stride = array.itemsize
+    for n in reversed(array.shape):
+        strides.append(stride)
+        stride *= n
+    return tuple(reversed(strides))
+
+frame_header = namedtuple("frame_header", ["magic","version","codec","ndim","flags","typestr","shape","strides",
+    "nbytes","payload","seq","framestamp","timestamp","recvtime","sendtime"])
+
+def unpack_header(buffer, offset=0):
+    """Read the header at offset in buffer into a frame_header, raises ValueError if it isn't a frame header"""
+    v = HEADER.unpack_from(buffer, offset)
+    if v[0] != MAGIC:
+        raise ValueError("Not a frame header")
+    if v[1] != HEADER_VERSION:
+        raise ValueError(f"Unsupported frame header version {v[1]}")
+    ndim = v[3]
+    return frame_header(*v[:5], v[5].rstrip(b"\0"), v[6:6+ndim], v[6+MAX_DIMS:6+MAX_DIMS+ndim], *v[6+2*MAX_DIMS:])
+
+def header_meta(hdr):
+    """The META_DTYPE record held in a header"""
+    return numpy.array((hdr.seq, hdr.framestamp, hdr.timestamp, hdr.recvtime), dtype=META_DTYPE)[()]
+
+def array_from_header(hdr, buffer, offset=0, copy=True):
+    """Rebuild the frame described by hdr from a raw payload in buffer,
+    returns a frame_array with the metadata in .meta. With copy=False it views buffer"""
+    arr = numpy.ndarray(hdr.shape, dtype=hdr.typestr.decode(), buffer=buffer, offset=offset, strides=hdr.strides)
+    if copy:
+        arr = arr.copy()
+    return with_meta(arr, header_meta(hdr))
@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import h5py
+from astropy.io import fits
+
+from pydcam.utils.recorder import open_raw
+
+"""
+Random access to the frames of a saved recording without loading the whole file.
+
+HDF5 datasets are read a frame at a time, FITS and raw recordings are memory mapped.
+The last few frames read are kept in a small LRU cache and prefetch() reads frames
+in a background thread, so stepping or playing through a large file only touches
+the frames being shown.
+
+    src = open_frames("run.hdf5")
+    len(src), src.shape, src.dtype
+    frame = src[10]
+    src.prefetch(11, 12)
+"""
+
+class frame_source():
+    """Frames of a 3D array-like (numpy array, memmap or h5py dataset), read on demand.
+    fetch(i) can be replaced to read frames some other way."""
+    def __init__(self, data, cache_size=16, close=None, meta=None):
+        self.data = data
+        if len(data.shape) == 2:
+            self.count = 1
+            self.shape = tuple(data.shape)
+        else:
+            self.count = data.shape[0]
+            self.shape = tuple(data.shape[1:])
+        self.dtype = numpy.dtype(data.dtype)
+        self.meta = meta
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(1)
+        self._close = close
+
+    def __len__(self):
+        return self.count
+
+    def fetch(self, i):
+        if len(self.data.shape) == 2:
+            return numpy.asarray(self.data)
+        return numpy.asarray(self.data[i])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(f"frame {i} out of range, {self.count} frames")
+        with self.lock:
+            if i in self.cache:
+                self.cache.move_to_end(i)
+                return self.cache[i]
+            future = self.pending.get(i)
+        if future is not None:
+            return future.result()
+        frame = self.fetch(i)
+        self._store(i, frame)
+        return frame
+
+    def _store(self, i, frame):
+        with self.lock:
+            self.cache[i] = frame
+            self.cache.move_to_end(i)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _prefetch(self, i):
+        try:
+            frame = self.fetch(i)
+            self._store(i, frame)
+            return frame
+        finally:
+            with self.lock:
+                self.pending.pop(i, None)
+
+    def prefetch(self, *indices):
+        """Start reading frames in the background, wrapping round at the end"""
+        for i in indices:
+            i %= self.count
+            with self.lock:
+                if i in self.cache or i in self.pending:
+                    continue
+                self.pending[i] = self.pool.submit(self._prefetch, i)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.cache.clear()
+        self.data = None
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+class fits_source(frame_source):
+    """The primary image of a FITS file, memory mapped with the BZERO/BSCALE scaling
+    done per frame (astropy won't memory map scaled data)"""
+    def __init__(self, fname, cache_size=16):
+        self.hdul = fits.open(fname, memmap=True, do_not_scale_image_data=True)
+        hdr = self.hdul[0].header
+        self.bzero = hdr.get("BZERO", 0)
+        self.bscale = hdr.get("BSCALE", 1)
+        meta = None
+        if "FRAMES" in self.hdul:
+            table = self.hdul["FRAMES"].data
+            meta = numpy.rec.fromarrays([table[n] for n in table.names], names=[n.lower() for n in table.names])
+        super().__init__(self.hdul[0].data, cache_size=cache_size, close=self.hdul.close, meta=meta)
+        self.dtype = self.scaled_dtype(self.dtype)
+
+    def scaled_dtype(self, raw):
+        if self.bscale == 1 and self.bzero == 0:
+            return raw.newbyteorder("=")
+        if self.bscale == 1 and raw.kind == "i" and self.bzero == 1<<(8*raw.itemsize-1):
+            return numpy.dtype(f"u{raw.itemsize}")
+        if self.bscale == 1 and raw.kind == "u" and self.bzero == -(1<<(8*raw.itemsize-1)):
+            return numpy.dtype(f"i{raw.itemsize}")
+        return numpy.dtype(numpy.float64)
+
+    def fetch(self, i):
+        raw = super().fetch(i)
+        if self.dtype.kind == "f" and raw.dtype.kind != "f":
+            return raw*self.bscale + self.bzero
+        frame = raw.astype(self.dtype)
+        if self.bzero:
+            # the offset wraps round in the unsigned/signed type
+            frame += numpy.array(self.bzero).astype(self.dtype)
+        return frame
+
+def open_frames(fname, cache_size=16):
+    """A frame_source for a .hdf5, .fits or .raw recording"""
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == ".hdf5":
+        file = h5py.File(fname, "r")
+        meta = None
+        if "seq" in file:
+            meta = numpy.rec.fromarrays([file[n][:] for n in ("seq","framestamp","timestamp","recvtime")], names="seq,framestamp,timestamp,recvtime")
+        return frame_source(file["images"], cache_size=cache_size, close=file.close, meta=meta)
+    if ext == ".fits":
+        return fits_source(fname, cache_size=cache_size)
+    if ext == ".raw":
+        images = open_raw(fname)
+        return frame_source(images, cache_size=cache_size, meta=getattr(images, "meta", None))
+    raise ValueError(f"Can't open {fname}, use a .hdf5, .fits or .raw file")
@@ -1,8 +1,14 @@
 
-
 """
 
-Doesn't really work...
+A lossless local multi-process transport.
+
+The frames go in shared memory slots, only small descriptors go through the queues:
+    free  slot numbers the publisher can write to
+    full  (slot, frame header) of frames waiting for a reader
+both are served to the readers by a BaseManager running in the publisher process.
+publish() waits (up to timeout) for a free slot, so a slow reader slows the publisher
+instead of losing frames. With several readers each frame goes to one of them.
 
 """
 
@@ -12,58 +18,118 @@ import numpy
 
 import threading
 
-from pydcam.utils.cb_thread import CallbackThread
-
+from multiprocessing import shared_memory as shmem
 from multiprocessing.managers import BaseManager
-from queue import Empty, Full, Queue
+from queue import Empty, Queue
+
+from pydcam.utils.cb_thread import CallbackThread
+from pydcam.utils.frame_header import pack_header, unpack_header, array_from_header
+from pydcam.utils.shmem import _attach, _untrack, _unlink
 
 class QueueManager(BaseManager): pass
 
-HDR_SIZE = 64
-INFO_SIZE = 16
+free_queue = Queue()
+full_queue = Queue()
+queue_info = {}
+
+def get_free_queue():
+    return free_queue
 
-queue = Queue(maxsize=10)
+def get_full_queue():
+    return full_queue
 
-def get_queue():
-    return queue
+def get_info():
+    return queue_info
 
 class mpqueue_publisher():
-    def __init__(self, ip:str="127.0.0.1", port:int=5556, name:str='hama1234'):
-        QueueManager.register('get_queue', callable=get_queue)
+    def __init__(self, ip:str="127.0.0.1", port:int=5556, name:str='hama1234', size:int=2304*2304*2, nslots:int=8, timeout=1.):
+        self.shm_name = name+"_mpq"
+        try:
+            self.shmem_block = _untrack(shmem.SharedMemory(name=self.shm_name, size=size*nslots, create=True))
+        except FileExistsError:
+            print("Removing old shared memory block")
+            old = _attach(self.shm_name)
+            old.close()
+            _unlink(old)
+            self.shmem_block = _untrack(shmem.SharedMemory(name=self.shm_name, size=size*nslots, create=True))
+        self.size = size
+        self.nslots = nslots
+        self.timeout = timeout
+        self.seq = 0
+        self.dropped = 0
+
+        while not free_queue.empty():
+            free_queue.get_nowait()
+        while not full_queue.empty():
+            full_queue.get_nowait()
+        for i in range(nslots):
+            free_queue.put(i)
+        queue_info.update(name=self.shm_name, size=size, nslots=nslots)
+
+        QueueManager.register('get_free_queue', callable=get_free_queue)
+        QueueManager.register('get_full_queue', callable=get_full_queue)
+        QueueManager.register('get_info', callable=get_info)
         self.manager = QueueManager(address=(ip, port), authkey=name.encode())
         self.server = self.manager.get_server()
-        self.serve_thread = threading.Thread(target=self.server.serve_forever)
+        self.serve_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
         self.serve_thread.start()
 
     def publish(self, data:numpy.ndarray):
+        if data.nbytes > self.size:
+            print(f"Frame too big for the queue, {data.nbytes} > {self.size}")
+            return
         try:
-            queue.put_nowait(data)
-        except Full as e:
-            print(e)
+            slot = free_queue.get(timeout=self.timeout)
+        except Empty as e:
+            print("No free slot, is a reader running? Dropping frame")
+            self.dropped += 1
+            return
+        start = slot*self.size
+        tmp_array = numpy.ndarray(shape=data.shape, dtype=data.dtype, buffer=self.shmem_block.buf[start:start+data.nbytes])
+        tmp_array[:] = data
+        del tmp_array
+        full_queue.put((slot, pack_header(data, seq=self.seq)))
+        self.seq += 1
 
     def close(self):
         self.server.stop_event.set()
+        self.shmem_block.close()
+        _unlink(self.shmem_block)
 
 class mpqueue_reader(CallbackThread):
-    def __init__(self, ip:str="127.0.0.1", port:int=5556, name:str='hama1234', ratelimit=1):
+    """Gets frames from an mpqueue_publisher in another process.
+    With copy=False the callbacks get a read-only view of the slot, which is only
+    handed back to the publisher once they've all returned."""
+    def __init__(self, ip:str="127.0.0.1", port:int=5556, name:str='hama1234', ratelimit=0, copy=True):
         super().__init__(ratelimit=ratelimit)
-        QueueManager.register('get_queue')
+        QueueManager.register('get_free_queue')
+        QueueManager.register('get_full_queue')
+        QueueManager.register('get_info')
         self.ip = ip
         self.port = port
         self.name = name
-        self.connect()
+        self.copy = copy
+        self.shmem_block = None
+        self.slot = None
         self.queue_go = True
+        self.connect()
 
     def connect(self):
         print("Trying to connect")
         self.manager = QueueManager(address=(self.ip, self.port), authkey=self.name.encode())
         try:
             self.manager.connect()
+            self.free_queue:Queue = self.manager.get_free_queue()
+            self.full_queue:Queue = self.manager.get_full_queue()
+            info = self.manager.get_info()
+            if self.shmem_block is not None:
+                self.shmem_block.close()
+            self.shmem_block = _attach(info.get('name'))
+            self.size = info.get('size')
         except Exception as e:
             print(e)
             self.connected = False
         else:
-            self.queue:Queue = self.manager.get_queue()
             self.connected = True
 
     def get_data(self):
@@ -72,14 +138,36 @@ class mpqueue_reader(CallbackThread):
             self.connect()
         while self.queue_go:
             try:
-                return self.queue.get(timeout=1)
+                slot, header = self.full_queue.get(timeout=1)
             except Empty as e:
-                print(e)
+                continue
             except Exception as e:
                 print(e)
                 self.connected = False
                 break
+            hdr = unpack_header(header)
+            arr = array_from_header(hdr, self.shmem_block.buf, offset=slot*self.size, copy=self.copy)
+            if self.copy:
+                self.free_queue.put(slot)
+            else:
+                arr.flags.writeable = False
+                self.slot = slot
+            return arr
+
+    def release_data(self, cb_data):
+        if self.slot is not None:
+            slot = self.slot
+            self.slot = None
+            self.free_queue.put(slot)
 
     def stop(self):
         super().stop()
         self.queue_go = False
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(2)
+        if self.shmem_block is not None:
+            try:
+                self.shmem_block.close()
+            except BufferError:
+                # a callback kept a view of a slot
+                pass
@@ -1,27 +1,169 @@
 
 #!/usr/bin/env python3
 
+import os
 import ctypes
 import threading
+import time
 import numpy
 
+from pydcam.utils.counters import frame_counters
+
+# per-frame metadata kept alongside the images
+# seq: count of frames written to the buffer, framestamp: camera framestamp (-1 if unknown),
+# timestamp: camera timestamp in seconds, recvtime: host time.perf_counter() when the frame arrived
+META_DTYPE = numpy.dtype([('seq','<i8'),('framestamp','<i8'),('timestamp','<f8'),('recvtime','<f8')])
+
+class frame_array(numpy.ndarray):
+    """An ndarray carrying the frame metadata (a META_DTYPE record or array) in .meta"""
+    meta = None
+    def __array_finalize__(self, obj):
+        self.meta = getattr(obj, 'meta', None)
+
+def with_meta(array, meta):
+    """Return a frame_array view of array with meta attached"""
+    ret = array.view(frame_array)
+    ret.meta = meta
+    return ret
+
+READ_POLICIES = ("drop", "skip", "block")
+
+def alloc_frames(count, shape, dtype, path=None):
+    """Storage for count frames, in memory or, for deep histories, a memory mapped .npy file at path"""
+    if path is None:
+        return numpy.zeros((count, *shape), dtype=dtype)
+    if os.path.exists(path):
+        # unlink rather than truncate, anything still viewing the old frames keeps them
+        os.remove(path)
+    return numpy.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(count, *shape))
+
+def history_range(meta, seq, oldest, seconds=None, frames=None):
+    """The (first, last) seq of the frames from the last seconds (by recvtime) and/or last frames frames,
+    oldest is the oldest frame that's safe to read"""
+    last = seq - 1
+    first = max(oldest, 0)
+    if frames is not None:
+        first = max(first, seq - frames)
+    if seconds is not None:
+        ok = (meta['seq'] >= first) & (meta['recvtime'] >= time.perf_counter() - seconds)
+        first = int(meta['seq'][ok].min()) if ok.any() else seq
+    return first, last
+
+class frame_lease():
+    """A read-only view of a buffer slot that the producer won't overwrite until release().
+    If the producer needs the slot before that (the lease was held too long) it gives
+    the slot other memory instead, the lease keeps the old memory to itself until it's
+    released. Use as a context manager or call release(), don't use data after that."""
+    def __init__(self, buf, index, seq, meta):
+        self.buf = buf
+        self.index = index
+        self.seq = seq
+        self.memory = buf.slots[index]
+        self.data = with_meta(self.memory, meta)
+        self.data.flags.writeable = False
+        # the slot has been given new memory, ours goes back to the spares on release
+        self.detached = False
+        # only in attach mode, the camera doesn't know about leases and has already written
+        # the slot by the time this is set, so DCamReader doesn't lease in attach mode
+        self.overwritten = False
+        self.released = False
+
+    def detach(self):
+        """Called by the producer, with the buffer lock held, when the slot is given new memory"""
+        self.detached = True
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.buf.release(self)
+
+    def __enter__(self):
+        return self.data
+
+    def __exit__(self, *args):
+        self.release()
+
+class buf_reader():
+    """A named read position in a circ_buf with its own overrun policy and lag statistics.
+
+    policy:
+        "drop"  read every frame in order, if the producer laps the reader the oldest unread frames are dropped
+        "skip"  always read the newest frame, skipping any older unread frames
+        "block" read every frame in order, the producer waits (up to the buffer timeout) before overwriting an unread frame
+    """
+    def __init__(self, buf, name:str, policy:str="drop"):
+        if policy not in READ_POLICIES:
+            raise ValueError(f"Unknown read policy {policy}, use one of {READ_POLICIES}")
+        self.buf = buf
+        self.name = name
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.last_read = buf.seq - 1
+        self.frames_read = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lag = 0
+
+    def get_latest(self, block=1, copy=1):
+        return self.buf.read_next(self, block, copy)
+
+    def get(self, N):
+        return self.buf.read_many(self, N)
+
+    def lease(self, block=1):
+        """Like get_latest but returns a frame_lease on the slot instead of a copy"""
+        return self.buf.read_next(self, block, 0, lease=True)
+
+    def reset(self):
+        self.last_read = self.buf.seq - 1
+
+    def seek(self, seq):
+        """Make frame seq the next one read, e.g. the first of buf.history_range()"""
+        with self.lock:
+            self.last_read = seq - 1
+
+    def lag(self):
+        """Number of frames written but not yet read"""
+        return self.buf.seq - 1 - self.last_read
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "frames_read": self.frames_read,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "lag": self.lag(),
+            "max_lag": self.max_lag,
+        }
+
 class circ_buf():
-    """A very simple buffer to be used by single thread only, not thread safe"""
-    def __init__(self, shape:tuple, count:int, dtype:str, timeout=2.):
+    """A very simple buffer to be used by single thread only, not thread safe.
+    With path the frames are kept in a memory mapped file, so count can be large."""
+    def __init__(self, shape:tuple, count:int, dtype:str, timeout=2., path=None):
+        self.path = path
         self.size = None
         self.count = None
         self.dtype = None
         self.shape = None
         self.lock = threading.Lock()
-        self.wait = threading.Event()
+        # notified when a frame is written and when a blocking reader frees a slot
+        self.filled = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.seq = 0
+        self.readers = {}
+        self.blocking = []
+        # slot index -> frame_leases, the producer waits up to lease_timeout for them
+        # before giving the slot a spare array, the leased memory is never written
+        self.leases = {}
+        self.lease_timeout = 0.
+        self.spares = []
+        # id of detached memory -> number of leases still holding it
+        self.detached = {}
 
         self.resize(shape, count, dtype)
-        self.last_filled = count-1
-        self.last_read = count-1
-        self.full_bufs = 0
-        self.unread_bufs = 0
         self.timeout = timeout
         self._cancelled = False
+        self.counters = frame_counters()
 
     def resize(self, shape:tuple, count:int=None, dtype:str=None):
 
@@ -36,151 +178,539 @@ class circ_buf():
             except TypeError:
                 self.dtype = numpy.uint8
 
-        self.size = numpy.product(numpy.array(shape))*self.dtype.itemsize
+        self.size = int(numpy.prod(self.shape))*self.dtype.itemsize
 
-        buf_dim = (self.count, *self.shape)
         with self.lock:
-            self.bufs = numpy.zeros(buf_dim, dtype=numpy.dtype(self.dtype))
+            for index in list(self.leases):
+                self.free_slot(index, wait=False)
+            self.bufs = alloc_frames(self.count, self.shape, numpy.dtype(self.dtype), self.path)
+            # each slot's array, a view of bufs unless it was swapped for a spare under a lease
+            self.slots = list(self.bufs)
+            self.spares = []
+            self.detached = {}
+            self.meta = numpy.zeros(self.count, dtype=META_DTYPE)
+            self.meta['seq'] = -1
+            self.meta['framestamp'] = -1
             self.full_bufs = 0
-            self.unread_bufs = 0
             self.last_filled = self.count-1
-            self.last_read = self.count-1
+            for reader in self.readers.values():
+                reader.reset()
 
-    def copy_from_address(self,address,size):
+    def add_reader(self, name:str, policy:str="drop"):
+        """Add a named reader with its own read position, returns the buf_reader.
+        If it already exists the policy is updated."""
+        with self.lock:
+            reader = self.readers.get(name)
+            if reader is None:
+                reader = self.readers[name] = buf_reader(self, name, policy)
+            elif policy not in READ_POLICIES:
+                raise ValueError(f"Unknown read policy {policy}, use one of {READ_POLICIES}")
+            else:
+                reader.policy = policy
+            self.blocking = [r for r in self.readers.values() if r.policy == "block"]
+        return reader
+
+    def get_reader(self, name:str):
+        reader = self.readers.get(name)
+        if reader is None:
+            reader = self.add_reader(name)
+        return reader
+
+    def remove_reader(self, name:str):
+        with self.lock:
+            self.readers.pop(name, None)
+            self.blocking = [r for r in self.readers.values() if r.policy == "block"]
+            self.space.notify_all()
+
+    def reader_stats(self):
+        return {name:reader.stats() for name,reader in list(self.readers.items())}
+
+    def set_meta(self, index, framestamp=-1, timestamp=0.):
+        """Fill the metadata for slot index, call with the lock held"""
+        self.meta[index] = (self.seq, framestamp, timestamp, time.perf_counter())
+        self.seq += 1
+
+    def wait_for_space(self):
+        """Wait for blocking readers before the oldest frame is overwritten, call with the lock held"""
+        if self.full_bufs < self.count:
+            return
+        overwrite = self.seq - self.count
+        for reader in self.blocking:
+            if reader.last_read < overwrite:
+                if not self.space.wait_for(lambda: reader.last_read >= overwrite or reader not in self.blocking, self.timeout):
+                    print(f"Reader {reader.name} blocked too long, overwriting")
+                    reader.overruns += 1
+                    self.counters.add_overrun(reader.name, 1)
+
+    def free_slot(self, index, wait=True):
+        """Make sure nobody holds a lease on slot index before it's reused, call with the lock held.
+        A slot still leased gets a spare array, the leases keep the old one"""
+        if index not in self.leases:
+            return
+        if wait and self.lease_timeout:
+            self.space.wait_for(lambda: index not in self.leases, self.lease_timeout)
+        leases = self.leases.pop(index, ())
+        if not leases:
+            return
+        for lease in leases:
+            lease.detach()
+        if wait:
+            self.detached[id(self.slots[index])] = len(leases)
+            self.slots[index] = self.spares.pop() if self.spares else numpy.empty(self.shape, self.dtype)
+            self.counters.lease_swaps += 1
+
+    def release(self, lease:frame_lease):
+        with self.lock:
+            if lease.detached:
+                key = id(lease.memory)
+                if key in self.detached:
+                    self.detached[key] -= 1
+                    if self.detached[key] == 0:
+                        del self.detached[key]
+                        if len(self.spares) < self.count:
+                            self.spares.append(lease.memory)
+                return
+            leases = self.leases.get(lease.index)
+            if leases is not None and lease in leases:
+                leases.remove(lease)
+                if not leases:
+                    del self.leases[lease.index]
+                self.space.notify_all()
+
+    def copy_from_address(self,address,size,framestamp=-1,timestamp=0.):
         if size != self.size:
             print("buf wrong size")
             return None
         with self.lock:
+            self.wait_for_space()
+            self.free_slot((self.last_filled+1)%self.count)
             self.last_filled = (self.last_filled+1)%self.count
             self.full_bufs = min(self.full_bufs + 1,self.count)
-            self.unread_bufs = (self.unread_bufs + 1)
-            ctypes.memmove(self.bufs[self.last_filled].ctypes.data_as(ctypes.c_void_p), address, self.size)
-            self.wait.set()
+            ctypes.memmove(self.slots[self.last_filled].ctypes.data_as(ctypes.c_void_p), address, self.size)
+            self.set_meta(self.last_filled, framestamp, timestamp)
+            self.filled.notify_all()
+        return True
 
-    def copy_numpy(self, array:numpy.ndarray):
+    def copy_numpy(self, array:numpy.ndarray, framestamp=-1, timestamp=0.):
         if array.shape != self.bufs.shape[1:]:
             print("arr wrong shape")
             return None
         with self.lock:
+            self.wait_for_space()
+            self.free_slot((self.last_filled+1)%self.count)
             self.last_filled = (self.last_filled + 1)%self.count
             self.full_bufs = min(self.full_bufs + 1,self.count)
-            self.unread_bufs = (self.unread_bufs + 1)
-            self.bufs[self.last_filled] = numpy.copy(array)
-            self.wait.set()
+            self.slots[self.last_filled][...] = array
+            self.set_meta(self.last_filled, framestamp, timestamp)
+            self.filled.notify_all()
+        return True
 
     def get_to_fill(self):
-        return self.bufs[(self.last_filled + 1)%self.count]
+        with self.lock:
+            index = (self.last_filled + 1)%self.count
+            self.free_slot(index)
+            return self.slots[index]
 
-    def inc_last_filled(self):
-        self.last_filled = (self.last_filled + 1)%self.count
-        self.full_bufs = min(self.full_bufs + 1,self.count)
-        self.unread_bufs = (self.unread_bufs + 1)
-        self.wait.set()
+    def inc_last_filled(self, framestamp=-1, timestamp=0.):
+        with self.lock:
+            self.last_filled = (self.last_filled + 1)%self.count
+            self.full_bufs = min(self.full_bufs + 1,self.count)
+            self.set_meta(self.last_filled, framestamp, timestamp)
+            self.filled.notify_all()
+
+    def mark_filled(self, index, n=1, framestamp=-1, timestamp=0.):
+        """Used when something else (e.g. the camera in attach mode) wrote the
+        frames directly into bufs, index is the slot of the newest frame and
+        n is the number of new frames since the last call.
+        framestamp and timestamp belong to the newest frame.
+        The camera doesn't wait for blocking readers."""
+        with self.lock:
+            index = index%self.count
+            for i in range(min(n,self.count)):
+                for lease in self.leases.pop((index-i)%self.count, ()):
+                    lease.overwritten = True
+            self.seq += max(n-self.count,0)
+            for i in range(min(n,self.count)-1,0,-1):
+                self.set_meta((index-i)%self.count)
+            self.last_filled = index
+            self.full_bufs = min(self.full_bufs + n,self.count)
+            self.set_meta(index, framestamp, timestamp)
+            self.filled.notify_all()
+
+    def slot_of(self, seq):
+        """The slot holding frame seq, None if it isn't in the buffer, call with the lock held"""
+        age = self.seq - 1 - seq
+        if age < 0 or age >= self.full_bufs:
+            return None
+        index = (self.last_filled - age)%self.count
+        if self.meta['seq'][index] != seq:
+            return None
+        return index
+
+    def history_range(self, seconds=None, frames=None):
+        """The (first, last) seq of the frames from the last seconds and/or last frames frames still in the buffer"""
+        with self.lock:
+            # the oldest frame is the next to be overwritten
+            return history_range(self.meta, self.seq, self.seq - self.full_bufs + 1, seconds, frames)
+
+    def wait_new(self, after, block):
+        """Wait for a frame newer than seq after, call with the lock held"""
+        if self.seq - 1 > after:
+            return True
+        if not block:
+            print("No buffer available")
+            return False
+        self._cancelled = False
+        if not self.filled.wait_for(lambda: self.seq - 1 > after or self._cancelled, self.timeout):
+            print("No buffer available")
+            return False
+        if self._cancelled:
+            print("Cancelled")
+            return False
+        return True
 
     def get_last_filled(self):
-        if self.full_bufs > 0:
-            return self.bufs[self.last_filled]
-
-        self.wait.clear()
-        self.wait.wait()
-        with self.lock:
-            return self.bufs[self.last_filled]
-
-    def get_latest(self,block=0,copy=0):
-        if self.unread_bufs <= 0:
-            self.unread_bufs = 0
-            if block:
-                self.wait.clear()
-                self._cancelled = False
-                if not self.wait.wait(self.timeout):
-                    print("No buffer available")
-                    return None
+        with self.lock:
+            if self.full_bufs == 0:
+                self.filled.wait_for(lambda: self.full_bufs > 0)
+            return with_meta(self.slots[self.last_filled], self.meta[self.last_filled].copy())
+
+    def read_next(self, reader:buf_reader, block=1, copy=1, out=None, lease=False):
+        """Read one frame for reader according to its policy.
+        With copy the frame is copied (into out if given) and checked for being
+        overwritten during the copy, otherwise a view of the slot is returned,
+        or a frame_lease on the slot if lease is True."""
+        with reader.lock:
+            while True:
+                with self.lock:
+                    if not self.wait_new(reader.last_read, block):
+                        return None
+                    newest = self.seq - 1
+                    lag = newest - reader.last_read
+                    reader.max_lag = max(reader.max_lag, lag)
+                    if reader.policy == "skip":
+                        seq = newest
+                        reader.skipped += lag - 1
+                    else:
+                        seq = reader.last_read + 1
+                        oldest = self.seq - self.full_bufs
+                        if seq < oldest:
+                            # the oldest frame is next to be overwritten, leave it
+                            skip_to = min(oldest + 1, newest) if reader.policy != "block" else oldest
+                            print(f"Buf overran by {skip_to-seq}")
+                            reader.overruns += skip_to - seq
+                            self.counters.add_overrun(reader.name, skip_to - seq)
+                            seq = skip_to
+                    index = self.slot_of(seq)
+                    if index is None:
+                        # not in the buffer anymore (e.g. resized)
+                        reader.last_read = newest - 1
+                        continue
+                    meta = self.meta[index].copy()
+                    if not copy:
+                        reader.last_read = seq
+                        reader.frames_read += 1
+                        if reader.policy == "block":
+                            self.space.notify_all()
+                        if lease:
+                            ret = frame_lease(self, index, seq, meta)
+                            self.leases.setdefault(index, []).append(ret)
+                            return ret
+                        return with_meta(self.slots[index], meta)
+                if out is None:
+                    out = numpy.copy(self.slots[index])
+                else:
+                    out[...] = self.slots[index]
+                with self.lock:
+                    if self.meta['seq'][index] != seq:
+                        # overwritten while copying, try again with a newer frame
+                        reader.overruns += 1
+                        self.counters.add_overrun(reader.name, 1)
+                        reader.last_read = seq
+                        continue
+                    reader.last_read = seq
+                    reader.frames_read += 1
+                    if reader.policy == "block":
+                        self.space.notify_all()
+                return with_meta(out, meta)
+
+    def read_many(self, reader:buf_reader, N):
+        """Read N frames for reader, waiting for them as needed"""
+        ret_array = numpy.empty((N,*self.shape),dtype=self.dtype)
+        ret_meta = numpy.empty(N,dtype=META_DTYPE)
+        for i in range(N):
+            while True:
+                arr = self.read_next(reader, 1, 1, ret_array[i])
+                if arr is not None:
+                    break
                 if self._cancelled:
-                    print("Cancelled")
                     return None
-            else:
-                print("No buffer available")
-                return None
-        with self.lock:
-            if self.unread_bufs > self.count:
-                print(f"Buf overran by {self.unread_bufs-self.count}")
-                self.unread_bufs = self.count - 1
-                self.last_read = (self.last_filled+1)%self.count
-            else:
-                self.last_read = (self.last_read+1)%self.count
-                self.unread_bufs -= 1
-        if copy:
-            return numpy.copy(self.bufs[self.last_read])
-        else:
-            return self.bufs[self.last_read]
+            ret_meta[i] = arr.meta
+        return with_meta(ret_array, ret_meta)
+
+    def get_latest(self,block=0,copy=0,reader="get_latest"):
+        return self.read_next(self.get_reader(reader), block, copy)
 
     def reset_head(self):
-        self.last_read = self.last_filled
-        self.unread_bufs = 0
+        with self.lock:
+            for reader in self.readers.values():
+                reader.last_read = self.seq - 1
+            self.space.notify_all()
 
     def cancel_wait(self):
-        self._cancelled = True
-        self.wait.set()
+        with self.lock:
+            self._cancelled = True
+            self.filled.notify_all()
 
 class thread_buf(circ_buf):
     """A subclass of circ_buf to make thread safe access"""
-    def __init__(self, shape:tuple, count:int, dtype:str, timeout=2.):
-        super().__init__(shape, count, dtype, timeout)
-        self.read_lock = threading.Lock()
-        self.write_lock = threading.Lock()
+    def __init__(self, shape:tuple, count:int, dtype:str, timeout=2., path=None):
+        super().__init__(shape, count, dtype, timeout, path)
 
-    def get_latest(self,block=1,copy=1):
-        return super().get_latest(block,copy)
+    def get_latest(self,block=1,copy=1,reader="get_latest"):
+        return super().get_latest(block,copy,reader)
 
     def get_at_index(self,index):
         index = index%self.count
-        if index < self.last_filled or self.full_bufs > index:
-            return numpy.copy(self.bufs[index])
-        else:
-            self.wait.clear()
-            self.wait.wait()
-            self.get_at_index(index)
+        with self.lock:
+            if self.full_bufs <= index and index != self.last_filled:
+                self.filled.wait_for(lambda: self.full_bufs > index)
+            return with_meta(numpy.copy(self.slots[index]), self.meta[index].copy())
 
     def wait_for(self, N):
-        for i in range(N):
-            self.wait.clear()
-            self.wait.wait()
+        with self.lock:
+            until = self.seq + N
+            self.filled.wait_for(lambda: self.seq >= until or self._cancelled)
 
     def wrap_copy(self,start,end):
         start = start%self.count
         end = end%self.count
         N = end-start if end > start else self.count + end - start
         out_array = numpy.empty((N,*self.shape),dtype=self.dtype)
+        out_meta = numpy.empty(N,dtype=META_DTYPE)
+        for i in range(N):
+            out_array[i] = self.slots[(start+i)%self.count]
         if end > start:
-            out_array[:] = self.bufs[start:end]
+            out_meta[:] = self.meta[start:end]
         elif start >= end:
-            out_array[0:self.count-start] = self.bufs[start:]
-            out_array[self.count-start:] = self.bufs[:end]
-        return out_array
+            out_meta[0:self.count-start] = self.meta[start:]
+            out_meta[self.count-start:] = self.meta[:end]
+        return with_meta(out_array, out_meta)
+
+    def get(self, N, reader="get"):
+        return self.read_many(self.get_reader(reader), N)
+
+    def lease(self, block=1, reader="lease"):
+        """Get the next frame as a frame_lease, a read-only view that stays valid until released"""
+        return self.read_next(self.get_reader(reader), block, 0, lease=True)
+
+class seq_buf():
+    """A single producer ring buffer that takes no locks on the hot path.
+
+    Every frame gets a monotonically increasing sequence number, slot i holds
+    frame seq with i = seq%count. The producer stamps the slot with -1 while
+    writing and with seq when done, it never waits for readers. Readers
+    keep their own read sequence and check the stamp before and after copying,
+    a changed stamp means the slot was overwritten (torn) and the read moves on
+    to a newer frame. Same get_latest/get(N)/resize and reader interface as
+    thread_buf, but attach mode (mark_filled) and "block" readers are not supported.
+    """
+    def __init__(self, shape:tuple, count:int, dtype:str, timeout=2., path=None):
+        self.path = path
+        self.size = None
+        self.count = None
+        self.dtype = None
+        self.shape = None
+        self.timeout = timeout
+        self._cancelled = False
+        # readers set waiting before blocking, the producer swaps in a new event and sets the old one
+        self.wait = threading.Event()
+        self.waiting = False
+        self.seq = 0
+        # only used to add and remove readers
+        self.lock = threading.Lock()
+        self.readers = {}
+        self.counters = frame_counters()
 
-    def get(self, N):
-        if N > self.count:
-            ret_array = numpy.empty((N,*self.shape),dtype=self.dtype)
-            this_count = self.count - 1
-            full = (N//this_count)
-            left = N%this_count
-            for f in range(full):
-                ret_array[this_count*f:this_count*(f+1)] = self.get(this_count)
-            if left: ret_array[this_count*full:] = self.get(left)
-            return ret_array
-        else:
-            with self.read_lock:
-                if self.unread_bufs > self.count:
-                    print(f"Buf overran by {self.unread_bufs-self.count}")
-                    self.last_read = self.last_filled
-                    self.unread_bufs = self.count
-                if self.unread_bufs >= N:
-                    self.unread_bufs -= N
-                    arr = self.wrap_copy(self.last_read+1,self.last_read+1+N)
-                    self.last_read = (self.last_read+N)%self.count
-                    return arr
-                self.wait_for(N-self.unread_bufs)
-            return self.get(N)
+        self.resize(shape, count, dtype)
+
+    def resize(self, shape:tuple, count:int=None, dtype:str=None):
+        """Not safe while the producer is running, pause it first"""
+
+        self.shape = shape if isinstance(shape,tuple) else (shape,)
+
+        if count is not None:
+            self.count = count
+
+        if dtype is not None:
+            try:
+                self.dtype = numpy.dtype(dtype)
+            except TypeError:
+                self.dtype = numpy.uint8
+
+        self.size = int(numpy.prod(self.shape))*self.dtype.itemsize
+
+        self.bufs = alloc_frames(self.count, self.shape, numpy.dtype(self.dtype), self.path)
+        self.meta = numpy.zeros(self.count, dtype=META_DTYPE)
+        self.meta['seq'] = -1
+        self.meta['framestamp'] = -1
+        # python lists are quicker than numpy for single item access
+        self.stamps = [-1]*self.count
+        self.addresses = [self.bufs[i].ctypes.data for i in range(self.count)]
+        for reader in self.readers.values():
+            reader.reset()
+
+    def add_reader(self, name:str, policy:str="drop"):
+        """Add a named reader with its own read position, returns the buf_reader"""
+        if policy == "block":
+            raise ValueError("seq_buf never blocks the producer, use drop or skip")
+        with self.lock:
+            reader = self.readers.get(name)
+            if reader is None:
+                reader = self.readers[name] = buf_reader(self, name, policy)
+            else:
+                reader.policy = policy
+        return reader
+
+    get_reader = circ_buf.get_reader
+    reader_stats = circ_buf.reader_stats
+    read_many = circ_buf.read_many
+
+    def remove_reader(self, name:str):
+        with self.lock:
+            self.readers.pop(name, None)
+
+    def _start_write(self):
+        index = self.seq%self.count
+        self.stamps[index] = -1
+        return index
+
+    def _end_write(self, index, framestamp, timestamp):
+        seq = self.seq
+        self.meta[index] = (seq, framestamp, timestamp, time.perf_counter())
+        self.stamps[index] = seq
+        self.seq = seq + 1
+        if self.waiting:
+            self.waiting = False
+            wait, self.wait = self.wait, threading.Event()
+            wait.set()
+
+    def copy_from_address(self,address,size,framestamp=-1,timestamp=0.):
+        if size != self.size:
+            print("buf wrong size")
+            return None
+        index = self._start_write()
+        ctypes.memmove(self.addresses[index], address, self.size)
+        self._end_write(index, framestamp, timestamp)
+        return True
+
+    def copy_numpy(self, array:numpy.ndarray, framestamp=-1, timestamp=0.):
+        if array.shape != self.bufs.shape[1:]:
+            print("arr wrong shape")
+            return None
+        index = self._start_write()
+        self.bufs[index] = array
+        self._end_write(index, framestamp, timestamp)
+        return True
+
+    def get_to_fill(self):
+        return self.bufs[self._start_write()]
+
+    def inc_last_filled(self, framestamp=-1, timestamp=0.):
+        self._end_write(self.seq%self.count, framestamp, timestamp)
+
+    def history_range(self, seconds=None, frames=None):
+        """The (first, last) seq of the frames from the last seconds and/or last frames frames still in the buffer"""
+        # the slot after the newest could be being written
+        return history_range(self.meta, self.seq, self.seq - self.count + 1, seconds, frames)
+
+    def wait_seq(self, seq, block):
+        """Wait until frame seq has been written, returns False on timeout or cancel"""
+        if self.seq > seq:
+            return True
+        if not block:
+            print("No buffer available")
+            return False
+        self._cancelled = False
+        end = time.perf_counter() + self.timeout
+        while self.seq <= seq:
+            wait = self.wait
+            self.waiting = True
+            if self.seq > seq:
+                break
+            if not wait.wait(end - time.perf_counter()):
+                if self.seq > seq:
+                    break
+                print("No buffer available")
+                return False
+            if self._cancelled:
+                print("Cancelled")
+                return False
+        return True
+
+    def read(self, seq, out, out_meta):
+        """Copy frame seq into out, returns the seq actually read.
+        If seq has been overwritten the oldest safe frame is read instead."""
+        while True:
+            # the slot the producer could be writing is never safe
+            oldest = self.seq - self.count + 1
+            if seq < oldest:
+                seq = oldest
+            index = seq%self.count
+            if self.stamps[index] == seq:
+                out[...] = self.bufs[index]
+                out_meta[...] = self.meta[index]
+                if self.stamps[index] == seq:
+                    return seq
+            seq += 1
+
+    def read_next(self, reader:buf_reader, block=1, copy=1, out=None):
+        """Read one frame for reader according to its policy"""
+        with reader.lock:
+            want = reader.last_read + 1
+            if not self.wait_seq(want, block):
+                return None
+            newest = self.seq - 1
+            reader.max_lag = max(reader.max_lag, newest - reader.last_read)
+            if reader.policy == "skip":
+                reader.skipped += newest - want
+                want = newest
+            if copy:
+                if out is None:
+                    out = numpy.empty(self.shape, dtype=self.dtype)
+                meta = numpy.empty((), dtype=META_DTYPE)
+                seq = self.read(want, out, meta)
+                meta = meta[()]
+            else:
+                seq = max(want, self.seq - self.count + 1)
+                index = seq%self.count
+                out = self.bufs[index]
+                meta = self.meta[index].copy()
+            if seq != want:
+                print(f"Buf overran by {seq-want}")
+                reader.overruns += seq - want
+                self.counters.add_overrun(reader.name, seq-want)
+            reader.last_read = seq
+            reader.frames_read += 1
+            return with_meta(out, meta)
+
+    def get_latest(self,block=0,copy=0,reader="get_latest"):
+        """Get the next unread frame, skipping forward if the producer lapped the reader"""
+        return self.read_next(self.get_reader(reader), block, copy)
+
+    def get(self, N, reader="get"):
+        """Get the next N frames, waiting for them if needed"""
+        return self.read_many(self.get_reader(reader), N)
+
+    def reset_head(self):
+        for reader in list(self.readers.values()):
+            reader.last_read = self.seq - 1
+
+    def cancel_wait(self):
+        self._cancelled = True
+        self.waiting = False
+        wait, self.wait = self.wait, threading.Event()
+        wait.set()
 
 
 # a simple thread buf for testing
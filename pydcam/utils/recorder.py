@@ -0,0 +1,630 @@
+import os
+import mmap
+import json
+import zlib
+import threading
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import h5py
+from astropy.io import fits
+
+from pydcam.utils.numpy_circ_buf import META_DTYPE, with_meta
+from pydcam.utils.frame_codec import shuffle as byte_shuffle
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+"""
+Recorders that write frames to disk as they arrive.
+
+Register recorder.append as a callback, it queues the frames and a background thread
+writes them, so a run can be much longer than fits in memory. Once nframes have been
+queued append raises, which deregisters it. Use wait() to wait for the file to be finished
+or finish() to stop early.
+Or use feed(buf) to read frames straight from a thread_buf with its own reader.
+"""
+
+class RecorderDone(Exception):
+    pass
+
+class recorder(threading.Thread):
+    """Base class, subclasses implement open_file, write_frame and close_file"""
+    def __init__(self, fname, nframes=None, queue_size=64, exposure=0., timeout=1.):
+        super().__init__(daemon=True)
+        self.fname = fname
+        self.nframes = nframes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.exposure = exposure
+        self.timeout = timeout
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+        self.error = None
+        self.start_time = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def append(self, data):
+        """Queue a frame, raises RecorderDone once nframes are queued or after finish()"""
+        with self.lock:
+            if self.closed:
+                raise RecorderDone()
+            if not data.flags.writeable:
+                # a leased view, it's gone once we return
+                data = data.copy()
+            try:
+                self.queue.put(data, timeout=self.timeout)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self.queued += 1
+            if self.nframes is not None and self.queued >= self.nframes:
+                self._close()
+                raise RecorderDone()
+
+    def feed(self, buf, name="recorder", policy="block", start=None):
+        """Read frames from buf (a thread_buf or seq_buf) with our own reader instead of a callback.
+        Frames are copied out of the ring as they're read, the copy is checked for the slot being
+        overwritten meanwhile, so a frame queued for the writer can't change under it.
+        start is the seq of the first frame to read, by default the next one written"""
+        reader = buf.add_reader(name, policy)
+        if start is not None:
+            reader.seek(start)
+        def run():
+            while not self.closed:
+                item = reader.get_latest(block=1, copy=1)
+                if item is None:
+                    continue
+                try:
+                    self.queue.put(item, timeout=self.timeout)
+                except queue.Full:
+                    self.dropped += 1
+                    continue
+                with self.lock:
+                    self.queued += 1
+                    if self.nframes is not None and self.queued >= self.nframes and not self.closed:
+                        self._close()
+            buf.remove_reader(name)
+        self.feeder = threading.Thread(target=run, daemon=True)
+        self.feeder.start()
+
+    def _close(self):
+        self.closed = True
+        self.queue.put(None)
+
+    def finish(self):
+        """Stop accepting frames and wait for the queued ones to be written"""
+        with self.lock:
+            if not self.closed:
+                self._close()
+        self.wait()
+
+    def wait(self, timeout=None):
+        """Wait for the file to be finished, returns False on timeout"""
+        if not self.is_alive() and not self.done.is_set():
+            return False
+        return self.done.wait(timeout)
+
+    def frame_meta(self, data, index):
+        meta = getattr(data, 'meta', None)
+        if meta is not None and meta.ndim == 0:
+            return meta
+        return numpy.array((index, -1, 0., time.perf_counter()), dtype=META_DTYPE)[()]
+
+    def run(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                if self.written == 0:
+                    self.start_time = time.perf_counter()
+                    self.open_file(data)
+                self.write_frame(data, self.frame_meta(data, self.written))
+                self.written += 1
+        except Exception as e:
+            print("Recorder failed:",e)
+            self.error = e
+            # not under the lock, append may be holding it waiting for queue space
+            self.closed = True
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+        finally:
+            try:
+                if self.written:
+                    self.close_file()
+            except Exception as e:
+                print("Recorder failed to close:",e)
+                self.error = e
+            self.done.set()
+
+    def rate(self):
+        """Frames written per second"""
+        if self.start_time is None or self.written == 0:
+            return 0.
+        return self.written/(time.perf_counter()-self.start_time)
+
+    def open_file(self, first):
+        """Create the file, first is the first frame"""
+        raise NotImplementedError
+
+    def write_frame(self, data, meta):
+        raise NotImplementedError
+
+    def close_file(self):
+        raise NotImplementedError
+
+HDF5_COMPRESSION = ("gzip", "lzf", "blosc-lz4", "blosc-zstd", "bitshuffle-lz4")
+
+def available_hdf5_compression():
+    """The compression names that can be used here, blosc and bitshuffle need hdf5plugin"""
+    ret = ["gzip", "lzf"]
+    if hdf5plugin is not None:
+        ret += ["blosc-lz4", "blosc-zstd", "bitshuffle-lz4"]
+    return ret
+
+def hdf5_filter_args(compression=None, level=None, shuffle=True):
+    """create_dataset keyword arguments for a compression name"""
+    if compression is None or compression == "none":
+        return {}
+    if compression not in HDF5_COMPRESSION:
+        raise ValueError(f"Unknown compression {compression}, use one of {HDF5_COMPRESSION}")
+    if compression not in available_hdf5_compression():
+        raise ValueError(f"{compression} needs hdf5plugin")
+    if compression == "gzip":
+        return dict(compression="gzip", compression_opts=4 if level is None else level, shuffle=shuffle)
+    if compression == "lzf":
+        return dict(compression="lzf", shuffle=shuffle)
+    if compression == "bitshuffle-lz4":
+        return dict(hdf5plugin.Bitshuffle())
+    blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+    return dict(hdf5plugin.Blosc(cname=compression.split("-")[1], clevel=5 if level is None else level, shuffle=blosc_shuffle))
+
+def chunk_shape(chunks, shape):
+    """chunks is frames per chunk or a (frames, rows, ...) tuple, missing or too big sizes are the frame size"""
+    if chunks is None:
+        chunks = (1,)
+    elif isinstance(chunks, int):
+        chunks = (chunks,)
+    chunks = tuple(chunks) + tuple(shape[len(chunks)-1:])
+    return (max(1, chunks[0]), *(max(1, min(c, s)) for c, s in zip(chunks[1:], shape)))
+
+class hdf5_recorder(recorder):
+    """Streams frames into a resizable "images" dataset with per-frame seq, framestamp,
+    timestamp, recvtime and exposure datasets ("meta" links to exposure as before).
+
+    chunks is frames per chunk or a full chunk shape, one frame per chunk by default.
+    compression is one of available_hdf5_compression(). gzip chunks are compressed by
+    a pool of worker threads and written with write_direct_chunk, the others are
+    compressed by HDF5 in the writer thread."""
+    GROW = 64
+
+    def __init__(self, fname, nframes=None, queue_size=64, exposure=0., timeout=1., compression=None, level=None, shuffle=True, chunks=None, workers=2):
+        super().__init__(fname, nframes, queue_size, exposure, timeout)
+        self.filter_args = hdf5_filter_args(compression, level, shuffle)
+        self.compression = compression
+        self.level = 4 if level is None else level
+        self.shuffle = shuffle
+        self.chunks = chunks
+        self.workers = workers
+        self.pool = None
+
+    def open_file(self, first):
+        self.file = h5py.File(self.fname, "w")
+        shape = first.shape
+        size = self.nframes if self.nframes is not None else self.GROW
+        self.chunks = chunk_shape(self.chunks, shape)
+        self.images = self.file.create_dataset("images", (size, *shape), maxshape=(None, *shape),
+            chunks=self.chunks, dtype=first.dtype, **self.filter_args)
+        if self.compression == "gzip":
+            # frames are gathered into a block of chunks, compressed by the pool, and written in order
+            self.pool = ThreadPoolExecutor(self.workers)
+            self.pending = deque()
+            self.block = numpy.zeros((self.chunks[0], *shape), dtype=first.dtype)
+        self.meta_sets = {}
+        for name in META_DTYPE.names:
+            self.meta_sets[name] = self.file.create_dataset(name, (size,), maxshape=(None,), dtype=META_DTYPE[name])
+        self.meta_sets["exposure"] = self.file.create_dataset("exposure", (size,), maxshape=(None,), dtype="f")
+        self.file["meta"] = h5py.SoftLink("/exposure")
+        self.file.attrs["exposure"] = self.exposure
+        # metadata is written GROW frames at a time
+        self.meta_block = numpy.zeros(self.GROW, dtype=META_DTYPE)
+        self.meta_start = 0
+
+    def resize(self, n):
+        self.images.resize(n, axis=0)
+        for dset in self.meta_sets.values():
+            dset.resize(n, axis=0)
+
+    def write_frame(self, data, meta):
+        i = self.written
+        if i >= self.images.shape[0]:
+            self.resize(i + self.GROW)
+        if self.pool is None:
+            self.images[i] = data
+        else:
+            k = i%self.chunks[0]
+            self.block[k] = data
+            if k == self.chunks[0]-1:
+                self.submit_block(i-k)
+        self.meta_block[i - self.meta_start] = meta
+        if i - self.meta_start == self.GROW - 1:
+            self.flush_meta(i + 1)
+
+    def compress(self, chunk):
+        # the same bytes HDF5's shuffle and deflate filters would produce
+        return zlib.compress(byte_shuffle(chunk) if self.shuffle else chunk, self.level)
+
+    def submit_block(self, start):
+        """Split the block into chunks (padding the edges) and queue them for compression"""
+        shape = self.block.shape[1:]
+        for corner in numpy.ndindex(*(-(-s//c) for s, c in zip(shape, self.chunks[1:]))):
+            offset = tuple(n*c for n, c in zip(corner, self.chunks[1:]))
+            region = self.block[(slice(None), *(slice(o, o+c) for o, c in zip(offset, self.chunks[1:])))]
+            chunk = numpy.zeros(self.chunks, dtype=self.block.dtype)
+            chunk[tuple(slice(0, n) for n in region.shape)] = region
+            self.pending.append(((start, *offset), self.pool.submit(self.compress, chunk)))
+        while len(self.pending) > 2*self.workers:
+            self.write_chunk()
+
+    def write_chunk(self):
+        offset, future = self.pending.popleft()
+        self.images.id.write_direct_chunk(offset, future.result())
+
+    def flush_meta(self, end):
+        start = self.meta_start
+        if end <= start:
+            return
+        block = self.meta_block[:end-start]
+        for name in META_DTYPE.names:
+            self.meta_sets[name][start:end] = block[name]
+        self.meta_sets["exposure"][start:end] = self.exposure
+        self.meta_start = end
+
+    def close_file(self):
+        if self.pool is not None:
+            left = self.written%self.chunks[0]
+            if left:
+                self.block[left:] = 0
+                self.submit_block(self.written-left)
+            while self.pending:
+                self.write_chunk()
+            self.pool.shutdown()
+        self.flush_meta(self.written)
+        self.resize(self.written)
+        self.file.close()
+
+ALIGN = 4096
+
+class raw_recorder(recorder):
+    """Writes the frames back to back into a raw file, for when HDF5 and FITS are too slow.
+
+    Frames are gathered into a page aligned batch buffer and written with a single os.write,
+    which doesn't hold the GIL. With direct the file is opened with O_DIRECT (if the platform
+    and filesystem allow it) and each frame is padded to ALIGN bytes.
+    fname+".json" describes the layout and fname+".meta.npy" holds the per-frame metadata,
+    use open_raw to read it back."""
+    def __init__(self, fname, nframes=None, queue_size=64, exposure=0., timeout=1., direct=True, batch_bytes=16*1024*1024):
+        super().__init__(fname, nframes, queue_size, exposure, timeout)
+        self.direct = direct
+        self.batch_bytes = batch_bytes
+
+    def open_file(self, first):
+        flags = os.O_WRONLY|os.O_CREAT|os.O_TRUNC|getattr(os, "O_BINARY", 0)
+        self.fd = None
+        if self.direct and hasattr(os, "O_DIRECT"):
+            try:
+                self.fd = os.open(self.fname, flags|os.O_DIRECT, 0o666)
+            except OSError as e:
+                print("Can't use O_DIRECT here:",e)
+        if self.fd is None:
+            self.direct = False
+            self.fd = os.open(self.fname, flags, 0o666)
+        self.shape = first.shape
+        self.dtype = first.dtype
+        self.nbytes = first.nbytes
+        self.stride = -(-self.nbytes//ALIGN)*ALIGN if self.direct else self.nbytes
+        if self.nframes is not None and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, self.nframes*self.stride)
+            except OSError:
+                pass
+        self.batch_frames = max(1, self.batch_bytes//self.stride)
+        # anonymous maps are page aligned, as O_DIRECT needs
+        self.batch = mmap.mmap(-1, self.batch_frames*self.stride)
+        self.batch_view = memoryview(self.batch)
+        self.batch_count = 0
+        self.meta = []
+        self.write_json(0)
+
+    def write_frame(self, data, meta):
+        start = self.batch_count*self.stride
+        tmp_array = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self.batch_view[start:start+self.nbytes])
+        tmp_array[:] = data
+        del tmp_array
+        self.meta.append(meta)
+        self.batch_count += 1
+        if self.batch_count == self.batch_frames:
+            self.flush()
+
+    def flush(self):
+        size = self.batch_count*self.stride
+        view = self.batch_view[:size]
+        while size:
+            n = os.write(self.fd, view)
+            view = view[n:]
+            size -= n
+        self.batch_count = 0
+
+    def write_json(self, n):
+        info = {
+            "format": "pydcam-raw",
+            "version": 1,
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "stride": self.stride,
+            "nframes": n,
+            "exposure": self.exposure,
+        }
+        with open(self.fname+".json", "w") as jf:
+            json.dump(info, jf, indent=1)
+
+    def close_file(self):
+        self.flush()
+        n = self.written
+        os.ftruncate(self.fd, n*self.stride)
+        os.close(self.fd)
+        self.batch_view.release()
+        self.batch.close()
+        numpy.save(self.fname+".meta.npy", numpy.array(self.meta, dtype=META_DTYPE))
+        self.write_json(n)
+
+FITS_BLOCK = 2880
+# numpy dtype -> (BITPIX, BZERO, big endian dtype written)
+FITS_TYPES = {
+    "uint8": (8, None, ">u1"),
+    "int16": (16, None, ">i2"),
+    "uint16": (16, 32768, ">u2"),
+    "int32": (32, None, ">i4"),
+    "uint32": (32, 2147483648, ">u4"),
+    "int64": (64, None, ">i8"),
+    "float32": (-32, None, ">f4"),
+    "float64": (-64, None, ">f8"),
+}
+
+class fits_recorder(recorder):
+    """Streams frames into a FITS cube (NAXIS3 = frames) without holding it in memory.
+    The primary header is written first and NAXIS3 is rewritten on close, unsigned
+    types are stored offset with BZERO as usual. Per-frame seq, framestamp, timestamp
+    and recvtime go in a FRAMES binary table extension."""
+
+    def primary_header(self, n):
+        bitpix, bzero, _ = FITS_TYPES[self.dtype.name]
+        hdr = fits.Header()
+        hdr["SIMPLE"] = True
+        hdr["BITPIX"] = bitpix
+        hdr["NAXIS"] = len(self.shape)+1
+        for i, size in enumerate(reversed(self.shape)):
+            hdr[f"NAXIS{i+1}"] = size
+        hdr[f"NAXIS{len(self.shape)+1}"] = n
+        hdr["EXTEND"] = True
+        if bzero is not None:
+            hdr["BSCALE"] = 1
+            hdr["BZERO"] = bzero
+        hdr["EXPTIME"] = self.exposure
+        hdr["DATE"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.start_wall))
+        return hdr.tostring().encode("ascii")
+
+    def open_file(self, first):
+        self.shape = first.shape
+        self.dtype = first.dtype
+        if self.dtype.name not in FITS_TYPES:
+            raise TypeError(f"Can't write {self.dtype} to FITS")
+        _, self.bzero, self.fits_dtype = FITS_TYPES[self.dtype.name]
+        self.start_wall = time.time()
+        self.file = open(self.fname, "wb")
+        self.file.write(self.primary_header(self.nframes or 0))
+        self.tmp = numpy.empty(self.shape, dtype=self.fits_dtype)
+        self.meta = []
+
+    def write_frame(self, data, meta):
+        tmp = self.tmp
+        tmp[:] = data
+        if self.bzero is not None:
+            # value - BZERO as signed is the same as flipping the top bit
+            tmp ^= numpy.array(self.bzero, dtype=self.fits_dtype)
+        self.file.write(tmp.data)
+        self.meta.append(meta)
+
+    def close_file(self):
+        n = self.written
+        pad = -self.file.tell()%FITS_BLOCK
+        self.file.write(b"\0"*pad)
+        self.file.seek(0)
+        self.file.write(self.primary_header(n))
+        self.file.close()
+        meta = numpy.array(self.meta, dtype=META_DTYPE)
+        table = fits.BinTableHDU.from_columns([
+            fits.Column(name="SEQ", format="K", array=meta["seq"]),
+            fits.Column(name="FRAMESTAMP", format="K", array=meta["framestamp"]),
+            fits.Column(name="TIMESTAMP", format="D", unit="s", array=meta["timestamp"]),
+            fits.Column(name="RECVTIME", format="D", unit="s", array=meta["recvtime"]),
+        ], name="FRAMES")
+        fits.append(self.fname, table.data, table.header)
+
+def open_raw(fname, mode="r"):
+    """Memory map a raw_recorder file, returns an (N, ...) frame_array with the metadata in .meta"""
+    with open(fname+".json") as jf:
+        info = json.load(jf)
+    if info.get("format") != "pydcam-raw":
+        raise ValueError(f"{fname} isn't a pydcam raw file")
+    shape = tuple(info["shape"])
+    dtype = numpy.dtype(info["dtype"])
+    n = info["nframes"]
+    frame_strides = numpy.empty(shape, dtype=dtype).strides
+    raw = numpy.memmap(fname, dtype=numpy.uint8, mode=mode, shape=(n*info["stride"],))
+    images = numpy.ndarray((n, *shape), dtype=dtype, buffer=raw, strides=(info["stride"], *frame_strides))
+    meta = None
+    if os.path.exists(fname+".meta.npy"):
+        meta = numpy.load(fname+".meta.npy")
+    return with_meta(images, meta)
+
+def convert_raw(fname, rec:recorder):
+    """Write a raw file out with another recorder (not started), e.g. convert_raw(f, hdf5_recorder(f+".hdf5"))"""
+    images = open_raw(fname)
+    with open(fname+".json") as jf:
+        rec.exposure = json.load(jf).get("exposure", rec.exposure)
+    meta = images.meta
+    for i in range(images.shape[0]):
+        frame = numpy.asarray(images[i])
+        if i == 0:
+            rec.open_file(frame)
+        rec.write_frame(frame, meta[i] if meta is not None else rec.frame_meta(frame, i))
+        rec.written += 1
+    if rec.written:
+        rec.close_file()
+
+def raw_to_fits(fname, out=None):
+    if out is None:
+        out = os.path.splitext(fname)[0]+".fits"
+    convert_raw(fname, fits_recorder(out))
+    return out
+
+def raw_to_hdf5(fname, out=None):
+    if out is None:
+        out = os.path.splitext(fname)[0]+".hdf5"
+    convert_raw(fname, hdf5_recorder(out))
+    return out
+
+class writer_pool():
+    """Fans frames out to several recorders, each writes its own file in its own thread so
+    the formats are written in parallel with each other and with the capture.
+    Register append as a callback, or use write_images for frames already in memory."""
+    def __init__(self, recorders):
+        self.recorders = list(recorders)
+
+    def start(self):
+        for rec in self.recorders:
+            rec.start()
+
+    def append(self, data):
+        """Queue a frame to every recorder, raises RecorderDone once they've all finished"""
+        if not data.flags.writeable:
+            # copy a leased view once rather than once per recorder
+            data = data.copy()
+        done = 0
+        for rec in self.recorders:
+            try:
+                rec.append(data)
+            except RecorderDone:
+                done += 1
+        if done == len(self.recorders):
+            raise RecorderDone()
+
+    def write_images(self, images, meta=None):
+        """Queue an array of images (N, ...) waiting for queue space instead of dropping frames,
+        meta defaults to images.meta. Doesn't wait for them to be written."""
+        if meta is None:
+            meta = getattr(images, 'meta', None)
+            if meta is not None and (meta.ndim != 1 or len(meta) != len(images)):
+                meta = None
+        for rec in self.recorders:
+            rec.timeout = None
+        for i in range(len(images)):
+            frame = numpy.asarray(images[i])
+            try:
+                self.append(with_meta(frame, meta[i]) if meta is not None else frame)
+            except RecorderDone:
+                break
+        self.finish(wait=False)
+
+    def finish(self, wait=True):
+        for rec in self.recorders:
+            with rec.lock:
+                if not rec.closed:
+                    rec._close()
+        if wait:
+            self.wait()
+
+    def wait(self, timeout=None):
+        """Wait for all the files to be finished, returns False on timeout"""
+        end = None if timeout is None else time.perf_counter()+timeout
+        for rec in self.recorders:
+            left = None if end is None else max(0, end-time.perf_counter())
+            if not rec.wait(left):
+                return False
+        return True
+
+    @property
+    def written(self):
+        return min((rec.written for rec in self.recorders), default=0)
+
+    @property
+    def dropped(self):
+        return max((rec.dropped for rec in self.recorders), default=0)
+
+    def backlog(self):
+        """Frames queued but not written yet, for the slowest recorder"""
+        return max((rec.queue.qsize() for rec in self.recorders), default=0)
+
+    def rate(self):
+        """Frames written per second by the slowest recorder"""
+        return min((rec.rate() for rec in self.recorders), default=0.)
+
+    def errors(self):
+        return [rec.error for rec in self.recorders if rec.error is not None]
+
+    def status(self, total=None):
+        """One line of progress for a status bar"""
+        total = total or max((rec.nframes or 0 for rec in self.recorders), default=0)
+        ret = f"Written {self.written}" + (f"/{total}" if total else "") + f" images, {self.rate():.1f} fps"
+        backlog = self.backlog()
+        if backlog:
+            ret += f", {backlog} queued"
+        if self.dropped:
+            ret += f", dropped {self.dropped}"
+        if self.errors():
+            ret += f", {len(self.errors())} failed"
+        return ret
+
+def snapshot(buf, recorders, seconds=None, frames=None, after=0, policy="drop"):
+    """Write the frames of the last seconds and/or last frames frames still in buf, plus the
+    next after frames, with each recorder (not started). The frames are fixed when it's called,
+    then each recorder reads them with its own reader starting back in the history.
+    With "drop" a recorder that falls too far behind loses the oldest frames rather than
+    holding up the camera. Returns the recorders, wait() on them."""
+    if isinstance(recorders, recorder):
+        recorders = [recorders]
+    first, last = buf.history_range(seconds, frames)
+    for rec in recorders:
+        rec.nframes = last - first + 1 + after
+        if rec.nframes <= 0:
+            print("Nothing to save")
+            rec.done.set()
+            continue
+        rec.start()
+        rec.feed(buf, name=f"snapshot:{rec.fname}", policy=policy, start=first)
+    return recorders
+
+def save_images(rec:recorder, images, meta=None):
+    """Write an array of images (N, ...) with rec (not started), meta defaults to images.meta"""
+    if meta is None:
+        meta = getattr(images, 'meta', None)
+        if meta is not None and (meta.ndim != 1 or len(meta) != len(images)):
+            meta = None
+    for i, frame in enumerate(images):
+        if i == 0:
+            rec.open_file(frame)
+        rec.write_frame(frame, meta[i] if meta is not None else rec.frame_meta(frame, i))
+        rec.written += 1
+    if rec.written:
+        rec.close_file()
@@ -1,114 +1,303 @@
-
-
-from distutils.log import info
 from multiprocessing import shared_memory as shmem
+import os
 import time
-import orjson
+import threading
+import platform
+import ctypes
 import numpy
 
 from pydcam.utils.cb_thread import CallbackThread
+from pydcam.utils.frame_header import HEADER_SIZE, pack_header, unpack_header, array_from_header
+
+"""
+A shared memory ring of frames, one publisher and any number of readers in other processes.
+
+name+"_info" holds the control block:
+    info[0] write_seq, the number of frames published, frame seq is in slot seq%nslots
+    info[1] number of slots
+    info[2] slot size in bytes
+    info[3] number of users of the control block
+    info[4] generation, incremented every time a publisher creates the data block
+    info[5] doorbell, the low 32 bits hold the low bits of write_seq, readers sleep on it
+followed by a stamp per slot (the seq of the frame in the slot, -1 while writing)
+and a frame header per slot (see frame_header.py).
+name holds the frame data, nslots*slot_size bytes.
+
+Readers never write to the control block (except the user count) so each has its
+own position and they don't interfere with each other or with the publisher.
+"""
+
+INFO_LEN = 8
+INFO_SIZE = INFO_LEN*8
+MAX_SLOTS = 64
+STAMP_SIZE = MAX_SLOTS*8
+HDR_SIZE = HEADER_SIZE
+HDR_START = INFO_SIZE + STAMP_SIZE
+CTRL_SIZE = HDR_START + MAX_SLOTS*HDR_SIZE
+
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+SYS_FUTEX = {"x86_64":202, "amd64":202, "aarch64":98, "arm64":98, "i386":240, "i686":240, "armv7l":240, "ppc64le":221}
 
-HDR_SIZE = 64
-INFO_SIZE = 16
+class timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
 
-class shmem_publisher():
-    def __init__(self, size, name='hama1234'):
+class doorbell():
+    """Wakes readers sleeping on a 32 bit word in shared memory.
+    Uses a futex on Linux, elsewhere readers fall back to polling."""
+    def __init__(self, word:numpy.ndarray):
+        self.word = word
+        self.address = ctypes.c_void_p(word.ctypes.data)
+        self.futex = None
+        if platform.system() == "Linux" and platform.machine() in SYS_FUTEX:
+            try:
+                self.libc = ctypes.CDLL(None, use_errno=True)
+                self.futex = self.libc.syscall
+                self.nr = SYS_FUTEX[platform.machine()]
+            except Exception as e:
+                print("No futex, polling instead:",e)
+                self.futex = None
+
+    def value(self):
+        return int(self.word[0])
+
+    def ring(self, value):
+        self.word[0] = value & 0x7fffffff
+        if self.futex is not None:
+            self.futex(self.nr, self.address, FUTEX_WAKE, 0x7fffffff, None, None, 0)
+
+    def wait(self, value, timeout=0.1):
+        """Sleep until the word isn't value, or timeout"""
+        if self.futex is None:
+            time.sleep(0.0001)
+            return
+        ts = timespec(int(timeout), int((timeout%1)*1e9))
+        self.futex(self.nr, self.address, FUTEX_WAIT, ctypes.c_int32(value), ctypes.byref(ts), None, 0)
+
+    def close(self):
+        del self.address
+        del self.word
+
+def _untrack(block):
+    """Stop the resource tracker unlinking block when this process exits,
+    the control block is shared by every user and the data block belongs to the publisher"""
+    if os.name == "posix":
         try:
-            self.shmem_header = shmem.SharedMemory(name=name+"_info", size=HDR_SIZE+INFO_SIZE, create=True)
-            created = True
-        except Exception as e:
-            print(e)
-            self.shmem_header = shmem.SharedMemory(name=name+"_info", size=HDR_SIZE+INFO_SIZE, create=False)
-            created = False
-        self.info = numpy.ndarray(shape=(INFO_SIZE//4,), dtype=numpy.int32, buffer=self.shmem_header.buf[:INFO_SIZE])
-        self.header = self.shmem_header.buf[INFO_SIZE:HDR_SIZE+INFO_SIZE]
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, "shared_memory")
+        except Exception:
+            pass
+    return block
+
+def _unlink(block):
+    """Unlink an untracked block"""
+    if os.name == "posix":
+        shmem._posixshmem.shm_unlink(block._name)
+    else:
+        block.unlink()
+
+def _attach(name):
+    return _untrack(shmem.SharedMemory(name=name, create=False))
+
+def _open_control(name):
+    """Open the control block, creating it if needed, returns (block, created)"""
+    try:
+        return _attach(name+"_info"), False
+    except FileNotFoundError:
+        pass
+    try:
+        return _untrack(shmem.SharedMemory(name=name+"_info", size=CTRL_SIZE, create=True)), True
+    except FileExistsError:
+        return _attach(name+"_info"), False
+
+class shmem_ring():
+    """Views of the control block shared by the publisher and readers"""
+    def __init__(self, name):
+        self.name = name
+        self.shmem_header, created = _open_control(name)
+        buf = self.shmem_header.buf
+        self.info = numpy.ndarray(shape=(INFO_LEN,), dtype=numpy.int64, buffer=buf[:INFO_SIZE])
+        self.stamps = numpy.ndarray(shape=(MAX_SLOTS,), dtype=numpy.int64, buffer=buf[INFO_SIZE:INFO_SIZE+STAMP_SIZE])
+        self.bell = doorbell(numpy.ndarray(shape=(1,), dtype=numpy.int32, buffer=buf[5*8:5*8+4]))
 
         if created:
             self.info[3] = 1
         else:
             self.info[3] = self.info[3] + 1
-        
-        self.shmem_block = shmem.SharedMemory(name=name, size=size, create=True)
-        self.info[2] = size
-
-    def publish(self, data:numpy.ndarray):
-        hdr = orjson.dumps((str(data.dtype),data.shape))
-        self.header[:len(hdr)] = hdr
-        tmp_array = numpy.ndarray(shape=data.shape, dtype=data.dtype, buffer=self.shmem_block.buf[:data.nbytes])
-        tmp_array[:] = data[:]
-        self.info[1] = len(hdr)
-        self.info[0] = data.nbytes
-        del tmp_array
 
-    def close(self):
+    def close_control(self):
         cnt = self.info[3]
-        if cnt == 1:
+        if cnt <= 1:
             print("Last user so closing")
-            self.shmem_header.unlink()
+            unlink = True
         else:
             self.info[3] = cnt-1
+            unlink = False
         del self.info
-        del self.header
-
+        del self.stamps
+        self.bell.close()
+        del self.bell
         self.shmem_header.close()
+        if unlink:
+            try:
+                _unlink(self.shmem_header)
+            except FileNotFoundError:
+                pass
 
-        self.shmem_block.close()
-        self.shmem_block.unlink()
+class shmem_publisher(shmem_ring):
+    def __init__(self, size, name='hama1234', nslots=8):
+        super().__init__(name)
+        if nslots > MAX_SLOTS:
+            print(f"Too many slots, using {MAX_SLOTS}")
+            nslots = MAX_SLOTS
 
-class shmem_reader(CallbackThread):
-    def __init__(self, name='hama1234', ratelimit=0):
-        super().__init__(ratelimit=ratelimit)
         try:
-            self.shmem_header = shmem.SharedMemory(name=name+"_info", size=HDR_SIZE+INFO_SIZE, create=False)
-            created = False
-        except FileNotFoundError as e:
+            self.shmem_block = shmem.SharedMemory(name=name, size=size*nslots, create=True)
+        except FileExistsError:
+            # left behind by a publisher that didn't close
+            print("Removing old shared memory block")
+            old = _attach(name)
+            old.close()
+            _unlink(old)
+            self.shmem_block = shmem.SharedMemory(name=name, size=size*nslots, create=True)
+        # unlinked in close(), a reader in this process attaching it would untrack it anyway
+        _untrack(self.shmem_block)
+
+        self.nslots = nslots
+        self.size = size
+        self.seq = int(self.info[0])
+        self.stamps[:] = -1
+        self.info[1] = nslots
+        self.info[2] = size
+        self.info[4] = self.info[4] + 1
+        self.slots = [self.shmem_block.buf[i*size:(i+1)*size] for i in range(nslots)]
+
+    def publish(self, data:numpy.ndarray):
+        if data.nbytes > self.size:
+            print(f"Frame too big for shared memory, {data.nbytes} > {self.size}")
+            return
+        seq = self.seq
+        slot = seq%self.nslots
+        self.stamps[slot] = -1
+        try:
+            pack_header(data, seq=seq, buffer=self.shmem_header.buf, offset=HDR_START+slot*HDR_SIZE)
+        except ValueError as e:
             print(e)
-            self.shmem_header = shmem.SharedMemory(name=name+"_info", size=HDR_SIZE+INFO_SIZE, create=True)
-            created = True
-        self.info = numpy.ndarray(shape=(INFO_SIZE//4,), dtype=numpy.int32, buffer=self.shmem_header.buf[:INFO_SIZE])
-        self.header = self.shmem_header.buf[INFO_SIZE:HDR_SIZE+INFO_SIZE]
+            return
+        tmp_array = numpy.ndarray(shape=data.shape, dtype=data.dtype, buffer=self.slots[slot][:data.nbytes])
+        tmp_array[:] = data
+        del tmp_array
+        self.stamps[slot] = seq
+        self.seq = seq + 1
+        self.info[0] = self.seq
+        self.bell.ring(self.seq)
 
-        if created:
-            self.info[3] = 1
-        else:
-            self.info[3] = self.info[3] + 1
+    def close(self):
+        for slot in self.slots:
+            slot.release()
+        del self.slots
+        self.close_control()
+
+        self.shmem_block.close()
+        _unlink(self.shmem_block)
+
+class shmem_reader(CallbackThread):
+    """Reads frames from a shmem_publisher in another process.
+
+    policy:
+        "skip"  always get the newest frame
+        "drop"  get every frame in order, if the publisher laps the reader the oldest frames are dropped
+    """
+    def __init__(self, name='hama1234', ratelimit=0, policy="skip"):
+        super().__init__(ratelimit=ratelimit)
+        if policy not in ("skip", "drop"):
+            raise ValueError(f"Unknown policy {policy}, use skip or drop")
+        self.ring = shmem_ring(name)
+        self.info = self.ring.info
 
         self.name = name
+        self.policy = policy
         self.shm_go = True
         self.size = 0
+        self.nslots = 0
+        self.generation = -1
         self.shmem_block = None
+        self.last_read = int(self.info[0]) - 1
+        self.overruns = 0
+
+    def open_block(self):
+        """(Re)open the data block if the publisher changed"""
+        if self.shmem_block is not None:
+            self.shmem_block.close()
+            self.shmem_block = None
+        self.generation = int(self.info[4])
+        self.nslots = int(self.info[1])
+        self.size = int(self.info[2])
+        try:
+            self.shmem_block = _attach(self.name)
+        except FileNotFoundError:
+            self.shmem_block = None
+            return False
+        return True
+
+    def read_slot(self, seq):
+        """Copy frame seq out of the ring, returns None if it was overwritten"""
+        slot = seq%self.nslots
+        if self.ring.stamps[slot] != seq:
+            return None
+        try:
+            hdr = unpack_header(self.ring.shmem_header.buf, HDR_START+slot*HDR_SIZE)
+            if hdr.nbytes > self.size:
+                return None
+            arr = array_from_header(hdr, self.shmem_block.buf, offset=slot*self.size)
+        except (ValueError, TypeError):
+            # the header was being rewritten
+            return None
+        if self.ring.stamps[slot] != seq:
+            return None
+        return arr
 
     def get_data(self):
-        if self.info is not None and self.shm_go: 
-            while self.shm_go and self.info[0] == 0:
-                time.sleep(0.0001)
-            if not self.shm_go: return
-            size = self.info[2]
-            hdr_size = self.info[1]
-            if size>self.size:
-                if self.shmem_block is not None:
-                    self.shmem_block.close()
-                    self.shmem_block = None
-                self.size = size
-                self.shmem_block = shmem.SharedMemory(name=self.name, size=size)
-            dtype, shape = orjson.loads(self.header[:hdr_size])
-            arr = numpy.ndarray(shape=shape, dtype=dtype, buffer=self.shmem_block.buf[:self.info[0]]).copy()
-            
-            self.info[0] = 0
-            return arr
+        while self.shm_go:
+            bell = self.ring.bell.value()
+            write_seq = int(self.info[0])
+            if write_seq - 1 <= self.last_read:
+                if write_seq - 1 < self.last_read:
+                    # the publisher restarted
+                    self.last_read = write_seq - 1
+                self.ring.bell.wait(bell)
+                continue
+            if self.generation != self.info[4] or self.shmem_block is None:
+                if not self.open_block():
+                    time.sleep(0.1)
+                    continue
+            if self.policy == "skip":
+                seq = write_seq - 1
+            else:
+                seq = self.last_read + 1
+            while seq < write_seq:
+                # the oldest slot may be being written
+                oldest = write_seq - self.nslots + 1
+                if seq < oldest:
+                    self.overruns += oldest - seq
+                    seq = oldest
+                arr = self.read_slot(seq)
+                self.last_read = seq
+                if arr is not None:
+                    return arr
+                # overwritten while reading
+                self.overruns += 1
+                seq += 1
+                write_seq = int(self.info[0])
 
     def stop(self):
         print("Stopping reader")
         super().stop()
-        cnt = self.info[3]
-        if cnt == 1:
-            print("Last user so closing")
-            self.shmem_header.unlink()
-        else:
-            self.info[3] = cnt-1
         self.shm_go = False
+        self.ring.bell.ring(self.ring.bell.value())
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(1)
         del self.info
-        del self.header
-        self.shmem_header.close()
+        self.ring.close_control()
         if self.shmem_block is not None:
             self.shmem_block.close()
@@ -0,0 +1,58 @@
+"""
+Camera-like frames for the simulator, cheap enough for thousands of frames per second.
+
+Each frame is a bias level with read noise and dark current, gaussian sources moving across
+the frame with photon noise, and hot pixels stuck at saturation, all clipped to the bit depth.
+Drawing fresh noise for every pixel of every frame costs too much, so a small bank of noise
+frames is made up front and cycled through, only the sources get new noise each frame.
+"""
+
+import numpy
+
+class sim_scene():
+    def __init__(self, shape=(1024,1024), bits=16, bias=100., read_noise=3., dark=0., sources=3,
+                 flux=50000., sigma=2., speed=50., hot_pixels=0, noise_frames=8, seed=None):
+        self.shape = tuple(shape)
+        self.bits = bits
+        self.max = (1<<bits)-1
+        self.dtype = numpy.dtype(numpy.uint8 if bits <= 8 else numpy.uint16)
+        self.rng = numpy.random.default_rng(seed)
+
+        # dark current adds its own (poisson) noise on top of the read noise
+        std = numpy.sqrt(read_noise**2 + dark)
+        self.noise = numpy.empty((noise_frames, *self.shape), dtype=self.dtype)
+        for i in range(noise_frames):
+            frame = self.rng.standard_normal(self.shape, dtype=numpy.float32)
+            frame *= std
+            frame += bias + dark
+            numpy.clip(numpy.rint(frame, out=frame), 0, self.max, out=frame)
+            self.noise[i] = frame
+
+        # sources start anywhere and move in a random direction at speed pixels per second
+        self.positions = self.rng.random((sources, 2))*self.shape
+        angles = self.rng.random(sources)*2*numpy.pi
+        self.velocities = numpy.stack((numpy.sin(angles), numpy.cos(angles)), axis=1)*speed
+        r = int(numpy.ceil(3*sigma))
+        y, x = numpy.mgrid[-r:r+1, -r:r+1]
+        psf = numpy.exp(-(x*x+y*y)/(2*sigma*sigma))
+        self.stamp = psf/psf.sum()*flux
+        self.radius = r
+
+        self.hot = self.rng.choice(int(numpy.prod(self.shape)), size=min(hot_pixels, int(numpy.prod(self.shape))), replace=False)
+
+    def render(self, t, out, index=0):
+        """Write the frame at time t (seconds) into out, index picks the noise frame"""
+        out[...] = self.noise[index%len(self.noise)]
+        r = self.radius
+        for pos, vel in zip(self.positions, self.velocities):
+            y, x = ((pos + vel*t)%self.shape).astype(int)
+            y0, y1 = max(y-r, 0), min(y+r+1, self.shape[0])
+            x0, x1 = max(x-r, 0), min(x+r+1, self.shape[1])
+            if y0 >= y1 or x0 >= x1:
+                continue
+            counts = self.rng.poisson(self.stamp[y0-y+r:y1-y+r, x0-x+r:x1-x+r])
+            region = out[y0:y1, x0:x1]
+            # saturate instead of wrapping round
+            region[...] = numpy.minimum(region + counts, self.max)
+        out.flat[self.hot] = self.max
+        return out
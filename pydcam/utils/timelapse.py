@@ -0,0 +1,141 @@
+import math
+import threading
+import time
+import numpy
+
+from pydcam.utils.recorder import RecorderDone
+from pydcam.utils.numpy_circ_buf import with_meta
+
+"""
+Time-lapse capture driven by the frame metadata instead of sleeping between captures.
+
+Register timelapse.append as a callback, it looks at the time of every frame (recvtime, or
+the camera timestamp) and passes the frame nearest each tick on to target, e.g. a recorder's
+or writer_pool's append. The ticks are start + k*interval so the timing doesn't drift, and
+the offset of each chosen frame from its tick is kept as jitter statistics.
+
+    tl = timelapse(10., nframes=360, target=pool.append)
+    camreader.register_callback(tl.append)
+    tl.wait()
+"""
+
+class timelapse():
+    def __init__(self, interval, nframes=None, target=None, start=None, clock="recvtime"):
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if clock not in ("recvtime", "timestamp"):
+            raise ValueError("clock must be recvtime or timestamp")
+        self.interval = interval
+        self.nframes = nframes
+        self.target = target
+        self.clock = clock
+        # the time of the first tick, the first frame's time if None
+        self.start = start
+        self.tick = 0
+        self.count = 0
+        self.missed = 0
+        self.period = None
+        self.last_time = None
+        self.candidate = None
+        self.candidate_time = None
+        self.jitter_sum = 0.
+        self.jitter_sumsq = 0.
+        self.jitter_max = 0.
+        self.closed = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def frame_time(self, data):
+        meta = getattr(data, 'meta', None)
+        if meta is not None and meta.ndim == 0:
+            return float(meta[self.clock])
+        return time.perf_counter()
+
+    def next_tick(self):
+        return self.start + self.tick*self.interval
+
+    def append(self, data):
+        """The frame callback, raises RecorderDone once nframes have been passed on or after stop()"""
+        with self.lock:
+            if self.closed:
+                raise RecorderDone()
+            t = self.frame_time(data)
+            if self.last_time is not None and t > self.last_time:
+                # a running estimate of the frame period
+                dt = t - self.last_time
+                self.period = dt if self.period is None else 0.9*self.period + 0.1*dt
+            self.last_time = t
+            if self.start is None:
+                self.start = t
+            tick = self.next_tick()
+            while t - tick > self.interval/2 and self.candidate is None:
+                # a stall or the frames are slower than the interval, no frame near this tick
+                self.missed += 1
+                self.tick += 1
+                tick = self.next_tick()
+            if t < tick:
+                # keep it if the next frame might be further from the tick than this one
+                if self.period is not None and tick - t <= self.period:
+                    self.keep(data, t)
+                return
+            if self.candidate is not None and tick - self.candidate_time < t - tick:
+                self.emit(self.candidate, self.candidate_time, tick)
+            else:
+                self.emit(data, t, tick)
+            self.candidate = None
+            self.tick += 1
+            if self.closed:
+                raise RecorderDone()
+
+    def keep(self, data, t):
+        if self.candidate is None or self.candidate.shape != data.shape or self.candidate.dtype != data.dtype:
+            self.candidate = numpy.empty_like(numpy.asarray(data))
+        self.candidate[:] = data
+        self.candidate_time = t
+        meta = getattr(data, 'meta', None)
+        if meta is not None and meta.ndim == 0:
+            # it's handed on as is, keep() makes a new array for the next candidate
+            self.candidate = with_meta(self.candidate, meta.copy())
+
+    def emit(self, data, t, tick):
+        jitter = t - tick
+        self.jitter_sum += jitter
+        self.jitter_sumsq += jitter*jitter
+        self.jitter_max = max(self.jitter_max, abs(jitter))
+        self.count += 1
+        if self.target is not None:
+            try:
+                self.target(data)
+            except RecorderDone:
+                self._close()
+                return
+        if self.nframes is not None and self.count >= self.nframes:
+            self._close()
+
+    def _close(self):
+        self.closed = True
+        self.done.set()
+
+    def stop(self):
+        with self.lock:
+            self._close()
+
+    def wait(self, timeout=None):
+        """Wait for nframes to be captured, returns False on timeout"""
+        return self.done.wait(timeout)
+
+    def jitter(self):
+        """Mean, standard deviation and largest absolute offset of the frames from their ticks"""
+        if self.count == 0:
+            return 0., 0., 0.
+        mean = self.jitter_sum/self.count
+        std = math.sqrt(max(0., self.jitter_sumsq/self.count - mean*mean))
+        return mean, std, self.jitter_max
+
+    def status(self):
+        mean, std, worst = self.jitter()
+        ret = f"Captured {self.count}" + (f"/{self.nframes}" if self.nframes else "")
+        ret += f", jitter {mean*1e3:.2f}+-{std*1e3:.2f} ms (max {worst*1e3:.2f})"
+        if self.missed:
+            ret += f", missed {self.missed} ticks"
+        return ret
@@ -1,13 +1,17 @@
 
 
 import zmq
-import orjson
 import struct
 from functools import partial
 import numpy
 import time
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 from pydcam.utils.cb_thread import CallbackThread
+from pydcam.utils.frame_header import HEADER_SIZE, pack_header, unpack_header, array_from_header
+from pydcam.utils.frame_codec import codec_id, encode, decode
 
 CHARLEN = struct.calcsize('!B')
 pack_char = partial(struct.pack, '!B')
@@ -17,18 +21,17 @@ DOUBLELEN = struct.calcsize('!d')
 pack_double = partial(struct.pack, '!d')
 unpack_double = partial(struct.unpack, '!d')
 
-def pack_numpy(array):
-    header = orjson.dumps((str(array.dtype),array.shape))
-    message = pack_char(len(header)) + header + array.tobytes()
-    return message
+def pack_numpy(array, seq=0):
+    """A frame header followed by the array data"""
+    return pack_header(array, seq=seq) + array.tobytes()
 
-def unpack_numpy(msg):
-    raw_msglen = msg[:CHARLEN]
-    msglen = unpack_char(raw_msglen)[0]
-    array_info = orjson.loads(msg[CHARLEN:CHARLEN+msglen])
-    array = numpy.frombuffer(msg[CHARLEN+msglen:],dtype=array_info[0])
-    array.shape = array_info[1]
-    return array
+def unpack_numpy(msg, offset=0):
+    """Returns a read-only frame_array viewing msg, with the header metadata in .meta"""
+    hdr = unpack_header(msg, offset)
+    if hdr.codec:
+        payload = decode(msg[offset+HEADER_SIZE:offset+HEADER_SIZE+hdr.payload], hdr.codec, hdr.nbytes, hdr.typestr.decode())
+        return array_from_header(hdr, payload, copy=False)
+    return array_from_header(hdr, msg, offset+HEADER_SIZE, copy=False)
 
 def extend_timestamp(buffer):
     return buffer + pack_double(time.time())
@@ -40,21 +43,82 @@ def strip_timestamp(buffer):
     return buffer[DOUBLELEN:], unpack_double(buffer[:DOUBLELEN])[0]
 
 class zmq_publisher():
-    def __init__(self, ip="127.0.0.1", port=5556, topic='hamamatsu'):
+    """Sends each frame as a 3 part message, topic, frame header and the frame data.
+    The data is sent without copying, zmq keeps a reference to the array until it's sent.
+    hwm is the number of frames queued per subscriber before frames are dropped.
+
+    With a codec (see frame_codec.py) frames are compressed by a pool of worker threads and
+    sent in order by a sender thread, publish() doesn't wait. If the workers fall behind
+    by more than 2*workers frames new frames are dropped and counted in dropped."""
+    def __init__(self, ip="127.0.0.1", port=5556, topic='hamamatsu', hwm=4, send_timeout=1., codec="none", workers=2):
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
         self.socket.bind(f"tcp://{ip}:{port}")
         self.topic = topic.encode()
+        self.seq = 0
+        self.send_timeout = send_timeout
+        self.dropped = 0
+
+        self.codec = codec_id(codec)
+        if self.codec:
+            self.pool = ThreadPoolExecutor(workers)
+            self.send_queue = queue.Queue(maxsize=2*workers)
+            self.sender = threading.Thread(target=self.send_loop, daemon=True)
+            self.sender.start()
 
     def publish(self, data):
-        to_send = self.topic + pack_double(time.time()) + pack_numpy(data)
-        self.socket.send(to_send)
+        if not data.flags.c_contiguous:
+            data = numpy.ascontiguousarray(data)
+        if self.codec:
+            self.publish_compressed(data)
+            return
+        header = pack_header(data, seq=self.seq)
+        tracker = self.socket.send_multipart([self.topic, header, data], copy=False, track=True)
+        self.seq += 1
+        if not data.flags.writeable:
+            # probably a leased view of a ring slot, don't return (and release it) until zmq is done
+            try:
+                tracker.wait(self.send_timeout)
+            except zmq.NotDone:
+                print("zmq send timed out")
+
+    def publish_compressed(self, data):
+        if self.send_queue.full():
+            self.dropped += 1
+            return
+        if not data.flags.writeable:
+            # a leased view is released as soon as we return
+            data = data.copy()
+        self.send_queue.put((self.seq, data, self.pool.submit(encode, data, self.codec)))
+        self.seq += 1
+
+    def send_loop(self):
+        """Sends the compressed frames in the order they were published"""
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                return
+            seq, data, future = item
+            try:
+                payload = future.result()
+            except Exception as e:
+                print("Compression failed:",e)
+                continue
+            header = pack_header(data, seq=seq, codec=self.codec, payload=memoryview(payload).nbytes)
+            self.socket.send_multipart([self.topic, header, payload], copy=False)
         
     def close(self):
+        if self.codec:
+            self.send_queue.put(None)
+            self.sender.join()
+            self.pool.shutdown()
         self.socket.close()
 
 class zmq_reader(CallbackThread):
-    def __init__(self, ip="127.0.0.1", port=5556, topic='hamamatsu', ratelimit=0):
+    """Receives frames from a zmq_publisher, the arrays view the received message without copying.
+    With conflate only the newest queued frame is passed on, otherwise every frame is."""
+    def __init__(self, ip="127.0.0.1", port=5556, topic='hamamatsu', ratelimit=0, conflate=True, hwm=4):
         super().__init__(ratelimit=ratelimit)
 
         self.ip = ip
@@ -64,33 +128,60 @@ class zmq_reader(CallbackThread):
 
         self.topicfilter = topic.encode()
         self.socket.setsockopt(zmq.SUBSCRIBE, self.topicfilter)
-        self.socket.setsockopt(zmq.CONFLATE, 1)
+        # CONFLATE doesn't work with multipart messages, keep the queue short and drain it instead
+        self.socket.setsockopt(zmq.RCVHWM, hwm)
         self.socket.connect(f"tcp://{ip}:{port}")
-        self.socket.RCVTIMEO = 5000
+        # short timeout so stop() doesn't wait long for the thread
+        self.socket.RCVTIMEO = 500
+        self.conflate = conflate
 
         self.this_time = 0
+        self.dropped = 0
 
     def get_data(self):
         timeouts = 0
         while(True):
             try:
-                message = self.socket.recv()
+                message = self.socket.recv_multipart(copy=False)
+                while self.conflate and self.socket.poll(0):
+                    message = self.socket.recv_multipart(copy=False)
+                    self.dropped += 1
             except zmq.error.Again as e:
-                print("timeout")
+                if not self._go:
+                    return None
                 timeouts+=1
-                if timeouts > 3:
+                if timeouts%10 == 0:
+                    print("timeout")
+                if timeouts > 30:
                     return None
             except zmq.error.ZMQError as e:
                 print(e)
                 return None
             else:
-                buffer = message[len(self.topicfilter):]
-                buffer, self.this_time = strip_timestamp(buffer)
-                return unpack_numpy(buffer)
+                if len(message) != 3:
+                    print("Not a frame message")
+                    continue
+                try:
+                    hdr = unpack_header(message[1].buffer)
+                except ValueError as e:
+                    print(e)
+                    continue
+                self.this_time = hdr.sendtime
+                payload = message[2].buffer
+                if hdr.codec:
+                    try:
+                        payload = decode(payload, hdr.codec, hdr.nbytes, hdr.typestr.decode())
+                    except Exception as e:
+                        print("Can't decode frame:",e)
+                        continue
+                return array_from_header(hdr, payload, copy=False)
 
     def stop(self):
         print("Stopping reader")
         super().stop()
+        # zmq sockets aren't thread safe, let get_data finish first
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(1)
         self.socket.close()
 
 
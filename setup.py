@@ -32,7 +32,6 @@ setuptools.setup(
           'astropy',
           'toml',
           'h5py',
-          'orjson',
           'pysinewave@git+https://github.com/david-jenkins/pysinewave',
           'superqt@git+https://github.com/napari/superqt',
       ],
@@ -45,6 +44,7 @@ setuptools.setup(
             "dcam_reader=pydcam.bin:reader",
             "dcam_saver=pydcam.bin:saver",
             "dcam_display=pydcam.bin:display",
+            "pydcam-record=pydcam.dcam_record:main",
                             ],
     },
 )